@@ -0,0 +1,210 @@
+import json
+import logging
+import os
+import queue
+import subprocess
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import requests
+
+from config import *
+from electricity import add_insert_listener
+from metrics import ALERTS_TOTAL
+
+
+class Alert(object):
+    def __init__(self, rule: str, cust_id: str, time: datetime, message: str, value: float):
+        self.rule: str = rule
+        self.cust_id: str = cust_id
+        self.time: datetime = time
+        self.message: str = message
+        self.value: float = value
+
+    def to_dict(self) -> dict:
+        return {"rule": self.rule, "cust_id": self.cust_id, "time": self.time.isoformat(), "message": self.message,
+                "value": self.value}
+
+
+class LowBalanceRule(object):
+    """Fires once when res_amp falls below ``threshold`` and re-arms after it rose above threshold + ``recovery``."""
+    name: str = "low_balance"
+
+    def __init__(self, threshold: Decimal, recovery: Decimal = Decimal(0)):
+        self.threshold: Decimal = Decimal(threshold)
+        self.recovery: Decimal = Decimal(recovery)
+        self._armed: dict = {}
+
+    def evaluate(self, log: dict) -> Alert | None:
+        cust_id = log["cust_id"]
+        res_amp = Decimal(log["res_amp"])
+        if res_amp >= self.threshold + self.recovery:
+            self._armed[cust_id] = True
+            return None
+        if res_amp >= self.threshold or not self._armed.get(cust_id, True):
+            return None
+        self._armed[cust_id] = False
+        return Alert(self.name, cust_id, log["time"], f"Balance of {cust_id} is {res_amp}, below {self.threshold}",
+                     float(res_amp))
+
+
+class SpikeState(object):
+    def __init__(self):
+        self.time: datetime | None = None
+        self.mean: float = 0.0
+        self.variance: float = 0.0
+        self.samples: int = 0
+
+
+class SpikeRule(object):
+    """
+    Fires when the hourly consumption since the previous reading is more than ``z_score`` standard deviations above
+    its exponentially weighted mean. Consumption is normalised per hour because the polling interval varies.
+    """
+    name: str = "consumption_spike"
+
+    def __init__(self, z_score: float = 4.0, alpha: float = 0.05, min_samples: int = 24, min_rate: float = 0.0):
+        self.z_score: float = z_score
+        self.alpha: float = alpha
+        self.min_samples: int = min_samples
+        self.min_rate: float = min_rate
+        self._states: dict = {}
+
+    def evaluate(self, log: dict) -> Alert | None:
+        state = self._states.setdefault(log["cust_id"], SpikeState())
+        previous_time, state.time = state.time, log["time"]
+        used = float(log["prev_used_amp"])
+        if previous_time is None or log["time"] <= previous_time or used < 0:
+            return None
+        rate = used / ((log["time"] - previous_time).total_seconds() / 3600)
+        if state.samples == 0:
+            state.mean = rate
+            state.samples = 1
+            return None
+        alert = None
+        deviation = rate - state.mean
+        if state.samples >= self.min_samples and state.variance > 0 and rate >= self.min_rate \
+                and deviation > self.z_score * state.variance ** 0.5:
+            alert = Alert(self.name, log["cust_id"], log["time"],
+                          f"Consumption of {log['cust_id']} is {rate:.2f} per hour, usually {state.mean:.2f}", rate)
+        # Exponentially weighted mean and variance, constant memory per dormitory.
+        increment = self.alpha * deviation
+        state.mean += increment
+        state.variance = (1 - self.alpha) * (state.variance + deviation * increment)
+        state.samples += 1
+        return alert
+
+
+class WebhookNotifier(object):
+    def __init__(self, url: str, timeout: float = 10):
+        self.url: str = url
+        self.timeout: float = timeout
+
+    def send(self, alert: Alert):
+        requests.post(self.url, json=alert.to_dict(), timeout=self.timeout).raise_for_status()
+
+
+class FileNotifier(object):
+    def __init__(self, path: str):
+        self.path: str = path
+
+    def send(self, alert: Alert):
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(alert.to_dict(), ensure_ascii=False) + "\n")
+
+
+class CommandNotifier(object):
+    """Runs ``command`` with the alert as JSON on stdin and as ALERT_* environment variables."""
+
+    def __init__(self, command: list, timeout: float = 30):
+        self.command: list = list(command)
+        self.timeout: float = timeout
+
+    def send(self, alert: Alert):
+        environment = dict(os.environ, **{f"ALERT_{key.upper()}": str(value) for key, value in alert.to_dict().items()})
+        subprocess.run(self.command, input=json.dumps(alert.to_dict(), ensure_ascii=False), text=True, env=environment,
+                       timeout=self.timeout, check=True)
+
+
+class AlertEngine(object):
+    """
+    Evaluates the rules on every inserted reading and hands alerts to a worker thread that calls the notifiers, so
+    a slow webhook or command never delays polling. An alert of the same rule and dormitory is sent at most once per
+    ``cooldown``.
+    """
+
+    def __init__(self, rules: list, notifiers: list, cooldown: timedelta = timedelta(hours=6), queue_size: int = 100):
+        self.rules: list = rules
+        self.notifiers: list = notifiers
+        self.cooldown: timedelta = cooldown
+        self._last_sent: dict = {}
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._worker = threading.Thread(target=self._run, name="alerts", daemon=True)
+        self._worker.start()
+
+    def observe(self, log: dict):
+        log = dict(log, cust_id=str(log["cust_id"]))
+        with self._lock:
+            alerts = [alert for alert in (rule.evaluate(log) for rule in self.rules) if alert is not None]
+            alerts = [alert for alert in alerts if self._claim(alert)]
+        for alert in alerts:
+            try:
+                self._queue.put_nowait(alert)
+            except queue.Full:
+                ALERTS_TOTAL.inc(rule=alert.rule, result="dropped")
+                logging.warning(f"[{alert.cust_id}] Alert queue is full, dropping: {alert.message}")
+
+    def _claim(self, alert: Alert) -> bool:
+        key = (alert.rule, alert.cust_id)
+        last_sent = self._last_sent.get(key)
+        if last_sent is not None and alert.time - last_sent < self.cooldown:
+            ALERTS_TOTAL.inc(rule=alert.rule, result="suppressed")
+            return False
+        self._last_sent[key] = alert.time
+        return True
+
+    def _run(self):
+        while True:
+            alert = self._queue.get()
+            if alert is None:
+                return
+            logging.warning(f"[{alert.cust_id}] Alert: {alert.message}")
+            for notifier in self.notifiers:
+                try:
+                    notifier.send(alert)
+                    ALERTS_TOTAL.inc(rule=alert.rule, result="sent")
+                except Exception as err:
+                    ALERTS_TOTAL.inc(rule=alert.rule, result="failed")
+                    logging.error(f"[{alert.cust_id}] {type(notifier).__name__} failed: {err}")
+
+    def close(self, timeout: float = 5):
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._worker.join(timeout)
+
+
+def build_alert_engine() -> AlertEngine | None:
+    rules = []
+    if ALERT_LOW_BALANCE is not None:
+        rules.append(LowBalanceRule(ALERT_LOW_BALANCE, ALERT_LOW_BALANCE_RECOVERY))
+    if ALERT_SPIKE_Z_SCORE is not None:
+        rules.append(SpikeRule(ALERT_SPIKE_Z_SCORE, ALERT_SPIKE_ALPHA, ALERT_SPIKE_MIN_SAMPLES, ALERT_SPIKE_MIN_RATE))
+    notifiers = []
+    if ALERT_WEBHOOK_URL is not None:
+        notifiers.append(WebhookNotifier(ALERT_WEBHOOK_URL))
+    if ALERT_FILE is not None:
+        notifiers.append(FileNotifier(ALERT_FILE))
+    if ALERT_COMMAND is not None:
+        notifiers.append(CommandNotifier(ALERT_COMMAND))
+    if not rules:
+        return None
+    return AlertEngine(rules, notifiers, ALERT_COOLDOWN, ALERT_QUEUE_SIZE)
+
+
+alert_engine = build_alert_engine()
+if alert_engine is not None:
+    add_insert_listener(alert_engine.observe)
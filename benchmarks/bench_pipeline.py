@@ -0,0 +1,199 @@
+"""
+End-to-end benchmark of the fetch -> parse -> delta -> insert pipeline and of the API endpoints, run against the
+local mock portal and a scratch database.
+
+    python benchmarks/bench_pipeline.py --iterations 200 --latency 20
+    python benchmarks/bench_pipeline.py --json results.json
+    python benchmarks/bench_pipeline.py --baseline results.json --tolerance 0.25
+
+Database stages use DATABASE_URL from config.py with a separate database (--database-name) that is dropped
+afterwards. With --baseline the script exits with status 1 when a stage's p99 regressed by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+import uvicorn
+
+import electricity
+import main
+from config import *
+from database import LogRepository, set_repository
+from loadtest import percentile
+from mock_portal import MockPortal
+from poller import ElectricityPoller
+from student import StudentLoginMethod, StudentRequest
+
+
+class StageResult(object):
+    def __init__(self, name: str, samples: list, elapsed: float, errors: int):
+        self.name = name
+        self.samples = samples
+        self.elapsed = elapsed
+        self.errors = errors
+
+    def to_dict(self) -> dict:
+        return {
+            "count": len(self.samples),
+            "errors": self.errors,
+            "throughput": len(self.samples) / self.elapsed if self.elapsed else 0.0,
+            "p50_ms": percentile(self.samples, 50) if self.samples else 0.0,
+            "p99_ms": percentile(self.samples, 99) if self.samples else 0.0
+        }
+
+
+def run_stage(name: str, func, iterations: int, concurrency: int = 1) -> StageResult:
+    samples = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def run_once(index: int):
+        started = time.perf_counter()
+        try:
+            func(index)
+        except Exception:
+            with lock:
+                errors[0] += 1
+            return
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            samples.append(elapsed)
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(run_once, range(iterations)))
+    else:
+        for index in range(iterations):
+            run_once(index)
+    return StageResult(name, samples, time.perf_counter() - started, errors[0])
+
+
+def start_api(port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="api", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def reading_payload(cust_id: str, index: int, start: datetime) -> dict:
+    meter_time = start + timedelta(minutes=10 * index)
+    return {"success": True, "state": 200, "message": "", "data": {
+        "Id": cust_id, "Addr": "", "Name": "",
+        "Usedamp": f"{1000 + index * 0.05:.2f}", "Resamp": f"{max(0.0, 200 - index * 0.05):.2f}",
+        "Time": meter_time.strftime('%Y/%m/%d %H:%M:%S')
+    }}
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark the electricity pipeline against the mock portal.")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients for the API stages")
+    parser.add_argument("--dorms", type=int, default=20, help="Dormitories polled by the poll_all stage")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean latency of the mock portal in ms")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--database-name", default=f"{DATABASE_NAME}_benchmark")
+    parser.add_argument("--api-port", type=int, default=18088)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare against results written by --json")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    cust_ids = [str(1000 + index) for index in range(args.dorms)]
+    portal = MockPortal(cust_ids=cust_ids, latency=args.latency, jitter=args.jitter,
+                        failure_rate=args.failure_rate).start()
+    repository = LogRepository(DATABASE_URL, args.database_name, DATABASE_COLLECTION, ROLLUP_COLLECTION,
+                               serverSelectionTimeoutMS=DATABASE_SERVER_SELECTION_TIMEOUT_MS)
+    set_repository(repository)
+    repository.ensure_indexes()
+    # Readings are inserted directly so the insert stage measures the database rather than the journal file. main
+    # bound its own name with `from electricity import *`, its lifespan would flush the production journal into
+    # the scratch database.
+    electricity.journal = None
+    main.journal = None
+    electricity.latest_logs.invalidate()
+    main.login_session = StudentRequest(portal.url, StudentLoginMethod(portal.username, portal.password))
+    # The scheduler's poller reuses fresh readings, this one always goes to the portal.
+    poller = ElectricityPoller(main.get_electricity, cust_ids, workers=POLLING_WORKERS)
+    cust_id = cust_ids[0]
+    results = []
+
+    try:
+        results.append(run_stage(
+            "login", lambda _: StudentRequest(portal.url, StudentLoginMethod(portal.username, portal.password))
+            .login(), args.iterations))
+        fetch_data = {'method': 'geteldorbaseinfo', 'stuid': 1, 'xq': 4, 'custId': cust_id}
+        results.append(run_stage(
+            "fetch", lambda _: main.login_session.send_post("interface/index", fetch_data), args.iterations))
+        response_text = main.login_session.send_post("interface/index", fetch_data).text
+        results.append(run_stage("parse", lambda _: json.loads(response_text), args.iterations))
+        start = datetime.now() - timedelta(days=365)
+        payloads = [reading_payload(cust_id, index, start) for index in range(args.iterations)]
+        results.append(run_stage(
+            "delta", lambda index: electricity.ElectricityInfo(payloads[index], cust_id), args.iterations))
+        results.append(run_stage(
+            "insert", lambda index: electricity.ElectricityInfo(payloads[index], cust_id).insert2db(),
+            args.iterations))
+        results.append(run_stage("get_electricity", lambda _: main.get_electricity(cust_id), args.iterations))
+        results.append(run_stage("poll_all", lambda _: poller.poll_all(), max(1, args.iterations // 20)))
+
+        server = start_api(args.api_port)
+        api_url = f"http://127.0.0.1:{args.api_port}"
+        session = requests.Session()
+        token = {"access_token": ACCESS_TOKEN}
+        try:
+            results.append(run_stage(
+                "GET /", lambda _: session.get(f"{api_url}/", params={"cust_id": cust_id}).raise_for_status(),
+                args.iterations, args.concurrency))
+            results.append(run_stage(
+                "GET /get", lambda _: session.get(f"{api_url}/get", params=dict(token, cust_id=cust_id, force=True))
+                .raise_for_status(), args.iterations, args.concurrency))
+            results.append(run_stage(
+                "GET /logs", lambda _: session.get(f"{api_url}/logs", params=dict(token, cust_id=cust_id, limit=100))
+                .raise_for_status(), args.iterations, args.concurrency))
+            results.append(run_stage(
+                "GET /logs csv", lambda _: session.get(f"{api_url}/logs",
+                                                       params=dict(token, cust_id=cust_id, limit=0, file_type=1))
+                .raise_for_status(), max(1, args.iterations // 10), args.concurrency))
+        finally:
+            server.should_exit = True
+    finally:
+        poller.shutdown()
+        portal.stop()
+        repository.connect().drop_database(args.database_name)
+        repository.close()
+
+    report = {result.name: result.to_dict() for result in results}
+    print(f"{'stage':<16}{'count':>8}{'errors':>8}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, stage in report.items():
+        print(f"{name:<16}{stage['count']:>8}{stage['errors']:>8}{stage['throughput']:>12.1f}"
+              f"{stage['p50_ms']:>10.2f}{stage['p99_ms']:>10.2f}")
+    print(f"Upstream requests served by the mock portal: {portal.counters}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = [name for name, stage in report.items()
+                       if name in baseline and baseline[name]["p99_ms"] > 0
+                       and stage["p99_ms"] > baseline[name]["p99_ms"] * (1 + args.tolerance)]
+        if regressions:
+            print(f"p99 regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,78 @@
+"""
+Measure the latency of / while /get calls to the school site are in flight.
+
+Start the API first, then run for example:
+
+    python benchmarks/loadtest.py --url http://localhost:8088 --access-token ACCESS_TOKEN --get-callers 8
+
+The script first measures / alone, then again while --get-callers threads keep calling /get. With the blocking I/O
+offloaded from the event loop both runs should report about the same latency.
+"""
+import argparse
+import statistics
+import threading
+import time
+
+import requests
+
+
+def percentile(samples: list, percent: float) -> float:
+    samples = sorted(samples)
+    index = min(len(samples) - 1, max(0, round(percent / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+def measure_root(url: str, duration: float) -> list:
+    session = requests.Session()
+    samples = []
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        session.get(f"{url}/")
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def call_get(url: str, access_token: str, stop: threading.Event, counter: list):
+    session = requests.Session()
+    while not stop.is_set():
+        try:
+            session.get(f"{url}/get", params={"access_token": access_token}, timeout=60)
+            counter.append(1)
+        except requests.exceptions.RequestException:
+            pass
+
+
+def report(name: str, samples: list):
+    print(f"{name}: {len(samples)} requests, "
+          f"mean {statistics.mean(samples):.2f} ms, "
+          f"p50 {percentile(samples, 50):.2f} ms, "
+          f"p99 {percentile(samples, 99):.2f} ms, "
+          f"max {max(samples):.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test / latency while /get is busy.")
+    parser.add_argument("--url", default="http://localhost:8088")
+    parser.add_argument("--access-token", default="ACCESS_TOKEN")
+    parser.add_argument("--get-callers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    args = parser.parse_args()
+
+    report("/ idle", measure_root(args.url, args.duration))
+
+    stop = threading.Event()
+    counter = []
+    callers = [threading.Thread(target=call_get, args=(args.url, args.access_token, stop, counter), daemon=True)
+               for _ in range(args.get_callers)]
+    for caller in callers:
+        caller.start()
+    try:
+        report(f"/ with {args.get_callers} /get callers", measure_root(args.url, args.duration))
+    finally:
+        stop.set()
+    print(f"/get calls completed meanwhile: {len(counter)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Local stand-in for the GXJZY portal implementing the endpoints used by StudentRequest and get_electricity.
+
+Run it on its own and point BASE_URL at it:
+
+    python benchmarks/mock_portal.py --port 8081 --latency 50 --failure-rate 0.01
+
+or start it in-process with MockPortal(...).start() as the benchmark suite does.
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+SESSION_COOKIE = "ASP.NET_SessionId"
+
+
+class MockMeter(object):
+    """A dormitory meter whose reading advances every ``update_interval`` seconds."""
+
+    def __init__(self, cust_id: str, update_interval: float, res_amp: Decimal = Decimal("200.00"),
+                 used_amp: Decimal = Decimal("1000.00")):
+        self.cust_id = cust_id
+        self.update_interval = update_interval
+        self.started = time.time()
+        self.res_amp = res_amp
+        self.used_amp = used_amp
+
+    def reading(self) -> dict:
+        updates = int((time.time() - self.started) // self.update_interval)
+        used = Decimal("0.05") * updates
+        meter_time = datetime.fromtimestamp(self.started + updates * self.update_interval)
+        return {
+            "Id": self.cust_id,
+            "Addr": f"Building 1 Room {self.cust_id}",
+            "Name": f"Dorm {self.cust_id}",
+            "Usedamp": str(self.used_amp + used),
+            "Resamp": str(max(Decimal(0), self.res_amp - used)),
+            "Time": meter_time.strftime('%Y/%m/%d %H:%M:%S')
+        }
+
+
+class MockPortal(object):
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, username: str = "20230400000",
+                 password: str = "password", cust_ids: list = None, latency: float = 0.0, jitter: float = 0.0,
+                 failure_rate: float = 0.0, meter_interval: float = 600.0, session_lifetime: float = None):
+        self.username = username
+        self.password = password
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.failure_rate = failure_rate
+        self.session_lifetime = session_lifetime
+        self.meters: dict = {str(cust_id): MockMeter(str(cust_id), meter_interval)
+                             for cust_id in (cust_ids or ["1001"])}
+        self.sessions: dict = {}
+        self.logged_in: dict = {}
+        self.counters: dict = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="mock-portal", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def is_logged_in(self, session_id: str) -> bool:
+        with self._lock:
+            logged_in_at = self.logged_in.get(session_id)
+        if logged_in_at is None:
+            return False
+        return self.session_lifetime is None or time.time() - logged_in_at < self.session_lifetime
+
+    def _handler_class(self):
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _session_id(self):
+                cookie = SimpleCookie(self.headers.get("Cookie", ""))
+                return cookie[SESSION_COOKIE].value if SESSION_COOKIE in cookie else None
+
+            def _send(self, status: int, body: bytes = b"", content_type: str = "application/json",
+                      cookie: str = None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if cookie is not None:
+                    self.send_header("Set-Cookie", f"{SESSION_COOKIE}={cookie}; path=/; HttpOnly")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_json(self, data: dict, status: int = 200):
+                self._send(status, json.dumps(data).encode("utf-8"))
+
+            def _inject(self) -> bool:
+                if portal.latency or portal.jitter:
+                    time.sleep(max(0.0, random.gauss(portal.latency, portal.jitter)))
+                if portal.failure_rate and random.random() < portal.failure_rate:
+                    portal.count("injected_failure")
+                    self._send(500, b"Internal Server Error", "text/plain")
+                    return True
+                return False
+
+            def _form(self) -> dict:
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8") if length else ""
+                return {key: values[0] for key, values in parse_qs(body).items()}
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                portal.count(f"GET {path}")
+                if self._inject():
+                    return
+                if path in ("/", "/home/login"):
+                    session_id = uuid.uuid4().hex
+                    with portal._lock:
+                        portal.sessions[session_id] = time.time()
+                    self._send(200, b"<html></html>", "text/html", cookie=session_id)
+                elif path == "/interface/getVerifyCode":
+                    self._send(200, b"\x89PNG", "image/png")
+                elif path == "/home/logout":
+                    with portal._lock:
+                        portal.logged_in.pop(self._session_id(), None)
+                    self._send(200, b"<html></html>", "text/html")
+                else:
+                    self._send(404, b"Not Found", "text/plain")
+
+            def do_POST(self):
+                path = self.path.split("?")[0]
+                form = self._form()
+                portal.count(f"POST {path} {form.get('method', '')}".strip())
+                if self._inject():
+                    return
+                if path == "/interface/login":
+                    self._login(form)
+                elif path == "/interface/index":
+                    self._index(form)
+                else:
+                    self._send(404, b"Not Found", "text/plain")
+
+            def _login(self, form: dict):
+                session_id = self._session_id()
+                try:
+                    password = base64.b64decode(form.get("passWord", "")).decode("utf-8")
+                except ValueError:
+                    password = None
+                if session_id is None or form.get("sid") != portal.username or password != portal.password:
+                    self._send_json({"state": 500, "success": False, "message": "Login failed", "data": None})
+                    return
+                with portal._lock:
+                    portal.logged_in[session_id] = time.time()
+                self._send_json({"state": 200, "success": True, "message": "",
+                                 "data": {"studentid": portal.username, "token": uuid.uuid4().hex}})
+
+            def _index(self, form: dict):
+                if not portal.is_logged_in(self._session_id()):
+                    self._send(401, b"Unauthorized", "text/plain")
+                    return
+                method = form.get("method")
+                if method == "getelstudorbandinfo":
+                    self._send_json({"state": 200, "success": True, "message": "",
+                                     "data": [{"CustId": cust_id} for cust_id in portal.meters]})
+                elif method == "geteldorbaseinfo":
+                    meter = portal.meters.get(str(form.get("custId")))
+                    if meter is None:
+                        self._send_json({"state": 404, "success": False, "message": "No such dormitory",
+                                         "data": None})
+                        return
+                    self._send_json({"state": 200, "success": True, "message": "", "data": meter.reading()})
+                else:
+                    self._send_json({"state": 400, "success": False, "message": "Unknown method", "data": None})
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the GXJZY portal.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--username", default="20230400000")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--cust-ids", nargs="+", default=["1001"])
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean injected latency in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Standard deviation of the latency in ms")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument("--meter-interval", type=float, default=600.0, help="Seconds between meter updates")
+    parser.add_argument("--session-lifetime", type=float, default=None, help="Seconds until a login expires")
+    args = parser.parse_args()
+    portal = MockPortal(args.host, args.port, args.username, args.password, args.cust_ids, args.latency,
+                        args.jitter, args.failure_rate, args.meter_interval, args.session_lifetime)
+    print(f"Mock portal listening on {portal.url}")
+    try:
+        portal.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        portal.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import threading
+from typing import Callable
+
+
+class Subscription(object):
+    def __init__(self, cust_id: str | None, queue_size: int):
+        self.cust_id: str | None = cust_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped: int = 0
+
+
+class Broadcaster(object):
+    """
+    Fans inserted readings out to the subscribers of /stream. ``publish`` may be called from any thread, the event
+    is serialized once there and handed to the event loop, which puts it into the queue of every matching
+    subscriber. Queues are bounded: a client that does not keep up loses its oldest events instead of growing
+    memory or slowing down the others.
+    """
+
+    def __init__(self, serialize: Callable, queue_size: int = 16, max_subscribers: int = 500):
+        self.serialize: Callable = serialize
+        self.queue_size: int = max(1, queue_size)
+        self.max_subscribers: int = max_subscribers
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._subscriptions: set = set()
+        self._lock = threading.Lock()
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def stop(self):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+            self.loop = None
+        for subscription in subscriptions:
+            self._offer(subscription, None)
+
+    def subscribe(self, cust_id: str = None) -> Subscription | None:
+        """Returns None when ``max_subscribers`` are already connected."""
+        with self._lock:
+            if len(self._subscriptions) >= self.max_subscribers:
+                return None
+            subscription = Subscription(cust_id, self.queue_size)
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+        if subscription.dropped:
+            logging.info(f"Stream subscriber dropped {subscription.dropped} events")
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscriptions)
+
+    def publish(self, log: dict):
+        loop = self.loop
+        if loop is None or not self._subscriptions:
+            return
+        event = (str(log.get("cust_id")), self.serialize(log))
+        try:
+            loop.call_soon_threadsafe(self._dispatch, event)
+        except RuntimeError:
+            # The event loop was closed during shutdown.
+            pass
+
+    def _dispatch(self, event: tuple):
+        cust_id = event[0]
+        with self._lock:
+            subscriptions = [subscription for subscription in self._subscriptions
+                             if subscription.cust_id is None or subscription.cust_id == cust_id]
+        for subscription in subscriptions:
+            self._offer(subscription, event[1])
+
+    @staticmethod
+    def _offer(subscription: Subscription, payload):
+        try:
+            subscription.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            subscription.queue.get_nowait()
+            subscription.dropped += 1
+            subscription.queue.put_nowait(payload)
@@ -0,0 +1,357 @@
+"""
+Compact storage schema: readings live in a MongoDB time-series collection with cust_id as metaField and the amounts
+as fixed-point integers (``u`` = used_amp, ``r`` = res_amp, scaled by 10 ** decimals). ``difference`` and the
+``prev_*`` deltas are derived on read from the previous reading of the same dormitory, and the dormitory address and
+name are stored once per dormitory in a separate collection together with the time of its latest reading, which is
+also what deduplicates readings (time-series collections have no unique indexes).
+"""
+import logging
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from bson.decimal128 import Decimal128
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from database import LogRepository
+
+# Filters on these fields are passed to the server as they are, anything else is evaluated after decoding.
+POSITION_FIELDS: frozenset = frozenset(("cust_id", "time", "_id"))
+DORM_FIELDS: tuple = ("addr", "Name")
+
+
+def _plain(value):
+    """Normalise a filter operand to what decoded rows contain: Decimal and naive UTC datetimes."""
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _compare(value, operator: str, operand) -> bool:
+    if operator == "$eq":
+        return value == operand
+    if operator == "$ne":
+        return value != operand
+    if operator == "$in":
+        return value in [_plain(item) for item in operand]
+    if value is None:
+        return False
+    if operator == "$gt":
+        return value > operand
+    if operator == "$gte":
+        return value >= operand
+    if operator == "$lt":
+        return value < operand
+    if operator == "$lte":
+        return value <= operand
+    raise ValueError(f"Unsupported filter operator for the compact schema: {operator}")
+
+
+def matches(row: dict, filter_: dict) -> bool:
+    """Evaluate the subset of the MongoDB query language used by build_log_filter and the page cursors."""
+    for key, condition in filter_.items():
+        if key == "$and":
+            if not all(matches(row, part) for part in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(row, part) for part in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(name.startswith("$") for name in condition):
+            if not all(_compare(row.get(key), operator, _plain(operand)) for operator, operand in condition.items()):
+                return False
+        elif row.get(key) != _plain(condition):
+            return False
+    return True
+
+
+def filter_fields(filter_: dict) -> set:
+    fields = set()
+    for key, condition in filter_.items():
+        if key in ("$and", "$or"):
+            for part in condition:
+                fields |= filter_fields(part)
+        else:
+            fields.add(key)
+    return fields
+
+
+def position_filter(filter_: dict) -> dict:
+    """The cust_id and time conditions of ``filter_``, used to narrow the scan before the remaining conditions."""
+    match = {}
+    for part in [filter_] + [part for part in filter_.get("$and", []) if isinstance(part, dict)]:
+        for key in ("cust_id", "time"):
+            if key in part:
+                match[key] = part[key]
+    return match
+
+
+class CompactCursor(object):
+    """Lazily runs a find_logs query against the compact collection, decoding one batch at a time."""
+
+    def __init__(self, repository, filter_: dict, projection: dict = None, sort: list = None, limit: int = 0):
+        self.repository = repository
+        self.filter_: dict = filter_ or {}
+        self.projection: dict | None = projection
+        self.sort: list | None = sort
+        self.limit: int = limit if limit > 0 else 0
+        self._batch_size: int = 1000
+        self._cursor = None
+
+    def batch_size(self, batch_size: int):
+        self._batch_size = max(1, batch_size)
+        return self
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.close()
+
+    def __iter__(self):
+        pushed_down = filter_fields(self.filter_) <= POSITION_FIELDS
+        query = self.filter_ if pushed_down else position_filter(self.filter_)
+        self._cursor = self.repository.compact_collection.find(
+            query, {"_id": 1, "cust_id": 1, "time": 1, "u": 1, "r": 1}, sort=self.sort).batch_size(self._batch_size)
+        if pushed_down and self.limit:
+            self._cursor.limit(self.limit)
+        returned = 0
+        try:
+            batch = []
+            for row in self._cursor:
+                batch.append(row)
+                if len(batch) < self._batch_size:
+                    continue
+                for log in self._decode(batch, pushed_down):
+                    yield log
+                    returned += 1
+                    if self.limit and returned >= self.limit:
+                        return
+                batch = []
+            for log in self._decode(batch, pushed_down):
+                yield log
+                returned += 1
+                if self.limit and returned >= self.limit:
+                    return
+        finally:
+            self.close()
+
+    def _decode(self, batch: list, pushed_down: bool) -> list:
+        logs = self.repository.decode_rows(batch)
+        if not pushed_down:
+            logs = [log for log in logs if matches(log, self.filter_)]
+        return [self.repository.project(log, self.projection) for log in logs]
+
+
+class CompactLogRepository(LogRepository):
+    def __init__(self, url: str, database_name: str, collection_name: str, rollup_collection_name: str = "rollup",
+                 compact_collection_name: str = "log_ts", dorm_collection_name: str = "dorm", decimals: int = 3,
+                 meta_collection_name: str = "meta", **client_options):
+        super().__init__(url, database_name, collection_name, rollup_collection_name, meta_collection_name,
+                         **client_options)
+        self.compact_collection_name: str = compact_collection_name
+        self.dorm_collection_name: str = dorm_collection_name
+        self.decimals: int = decimals
+        self.scale: int = 10 ** decimals
+
+    @property
+    def compact_collection(self):
+        return self.database[self.compact_collection_name]
+
+    @property
+    def dorm_collection(self):
+        return self.database[self.dorm_collection_name]
+
+    def ensure_indexes(self):
+        if self.compact_collection_name not in self.database.list_collection_names():
+            self.database.create_collection(self.compact_collection_name, timeseries={
+                "timeField": "time", "metaField": "cust_id", "granularity": "minutes"})
+        self.compact_collection.create_index([("cust_id", ASCENDING), ("time", ASCENDING)], name="cust_id_time")
+        self.rollup_collection.create_index([("cust_id", ASCENDING), ("period", ASCENDING), ("start", ASCENDING)],
+                                            name="cust_id_period_start", unique=True)
+
+    # Encoding
+
+    def to_fixed(self, value) -> int:
+        if isinstance(value, Decimal128):
+            value = value.to_decimal()
+        return int(Decimal(value).scaleb(self.decimals).to_integral_value())
+
+    def encode(self, document: dict) -> dict:
+        return {"cust_id": document["cust_id"], "time": document["time"],
+                "u": self.to_fixed(document["used_amp"]), "r": self.to_fixed(document["res_amp"])}
+
+    def decode_rows(self, rows: list) -> list:
+        """
+        Decode a batch of stored rows into log documents. The previous reading of every row is looked up inside
+        the batch, only the earliest row of each dormitory in the batch costs one extra indexed query.
+        """
+        previous = {}
+        by_dorm = {}
+        for row in rows:
+            by_dorm.setdefault(row["cust_id"], []).append(row)
+        for cust_id, dorm_rows in by_dorm.items():
+            dorm_rows.sort(key=lambda row: row["time"])
+            before = self.compact_collection.find_one({"cust_id": cust_id, "time": {"$lt": dorm_rows[0]["time"]}},
+                                                      {"_id": 0, "u": 1, "r": 1}, sort=[("time", -1)])
+            for row in dorm_rows:
+                previous[id(row)] = before
+                before = row
+        exponent = -self.decimals
+        logs = []
+        for row in rows:
+            before = previous[id(row)]
+            used_delta = row["u"] - before["u"] if before is not None else 0
+            res_delta = row["r"] - before["r"] if before is not None else 0
+            prev_used_amp = Decimal(used_delta).scaleb(exponent)
+            prev_res_amp = Decimal(res_delta).scaleb(exponent)
+            logs.append({
+                "_id": row["_id"],
+                "cust_id": row["cust_id"],
+                "time": row["time"],
+                "used_amp": Decimal(row["u"]).scaleb(exponent),
+                "res_amp": Decimal(row["r"]).scaleb(exponent),
+                "difference": Decimal(row["u"] - row["r"]).scaleb(exponent),
+                "prev_used_amp": prev_used_amp,
+                "prev_res_amp": prev_res_amp,
+                "prev_ratio": prev_used_amp / abs(prev_res_amp) if used_delta and res_delta else Decimal(0)
+            })
+        return logs
+
+    @staticmethod
+    def project(log: dict, projection: dict = None) -> dict:
+        if not projection:
+            return log
+        return {key: value for key, value in log.items() if projection.get(key)}
+
+    # Reads
+
+    def find_logs(self, filter_: dict = None, projection: dict = None, sort: list = None, limit: int = 0):
+        return CompactCursor(self, filter_, projection, sort, limit)
+
+    def find_series(self, cust_id: str, field: str, start=None, end=None, batch_size: int = 10000):
+        filter_ = {"cust_id": cust_id}
+        if start is not None or end is not None:
+            filter_["time"] = {key: value for key, value in (("$gte", start), ("$lte", end)) if value is not None}
+        for log in self.find_logs(filter_, sort=[("time", ASCENDING)]).batch_size(batch_size):
+            yield {"t": int(log["time"].replace(tzinfo=timezone.utc).timestamp() * 1000), "v": float(log[field])}
+
+    def rebuild_rollups(self, period: str, timezone_name: str, cust_id: str = None):
+        match = {} if cust_id is None else {"cust_id": cust_id}
+        self.rollup_collection.delete_many(dict(match, period=period))
+        pipeline = [
+            {"$match": match},
+            {"$setWindowFields": {"partitionBy": "$cust_id", "sortBy": {"time": 1},
+                                  "output": {"previous_u": {"$shift": {"output": "$u", "by": -1}}}}},
+            {"$group": {
+                "_id": {"cust_id": "$cust_id",
+                        "start": {"$dateTrunc": {"date": "$time", "unit": period, "timezone": timezone_name}}},
+                "used": {"$sum": {"$subtract": ["$u", {"$ifNull": ["$previous_u", "$u"]}]}},
+                "count": {"$sum": 1},
+                "min_res_amp": {"$min": "$r"},
+                "max_res_amp": {"$max": "$r"}
+            }},
+            {"$project": {"_id": 0, "cust_id": "$_id.cust_id", "period": {"$literal": period}, "start": "$_id.start",
+                          "count": 1,
+                          **{key: {"$divide": [{"$toDecimal": f"${key}"}, self.scale]}
+                             for key in ("used", "min_res_amp", "max_res_amp")}}},
+            {"$merge": {"into": self.rollup_collection_name, "on": ["cust_id", "period", "start"],
+                        "whenMatched": "replace", "whenNotMatched": "insert"}}
+        ]
+        self.compact_collection.aggregate(pipeline, allowDiskUse=True)
+
+    # Writes
+
+    def _claim(self, document: dict) -> bool:
+        """Advance the dormitory's latest reading time, False when ``document`` is not newer than it."""
+        metadata = {key: document[key] for key in DORM_FIELDS if key in document}
+        try:
+            self.dorm_collection.update_one(
+                {"_id": document["cust_id"], "$or": [{"last_time": {"$lt": document["time"]}},
+                                                     {"last_time": {"$exists": False}}]},
+                {"$set": dict(metadata, last_time=document["time"])}, upsert=True)
+        except DuplicateKeyError:
+            # The dormitory exists with a newer or equal last_time, so the upsert tried to insert a second one.
+            return False
+        return True
+
+    def insert_log(self, document: dict):
+        return self.upsert_log(document)
+
+    def upsert_log(self, document: dict):
+        if not self._claim(document):
+            return None
+        return self.compact_collection.insert_one(self.encode(document))
+
+    def insert_logs(self, documents: list) -> list:
+        """
+        Insert ``documents``, which may be older than the dormitory's last_time (a backfill): a reading is new when
+        no row of its dormitory has the same time. last_time only moves forward.
+        """
+        inserted = [False] * len(documents)
+        newest = {}
+        seen = set()
+        by_dorm = {}
+        for index, document in enumerate(documents):
+            by_dorm.setdefault(document["cust_id"], []).append(index)
+        for cust_id, indexes in by_dorm.items():
+            times = [documents[index]["time"] for index in indexes]
+            seen.update((cust_id, row["time"]) for row in self.compact_collection.find(
+                {"cust_id": cust_id, "time": {"$in": times}}, {"_id": 0, "time": 1}))
+            for index in indexes:
+                document = documents[index]
+                key = (cust_id, _plain(document["time"]))
+                if key in seen:
+                    continue
+                seen.add(key)
+                inserted[index] = True
+                if cust_id not in newest or document["time"] > newest[cust_id]["time"]:
+                    newest[cust_id] = document
+        rows = [self.encode(document) for document, new in zip(documents, inserted) if new]
+        if rows:
+            self.compact_collection.insert_many(rows, ordered=False)
+        for document in newest.values():
+            self._claim(document)
+        return inserted
+
+    def update_logs(self, updates: list) -> int:
+        # difference and prev_* are derived on read, there is nothing stored to correct.
+        return 0
+
+    def migrate(self, source: LogRepository, batch_size: int = 5000) -> int:
+        """
+        Copy the logs of ``source`` into the compact collection, one dormitory at a time in time order. Progress is
+        the newest reading of the dormitory already in the compact collection, not its last_time: a crash between
+        inserting a batch and updating last_time must not copy that batch a second time.
+        """
+        migrated = 0
+        for cust_id in source.collection.distinct("cust_id"):
+            if cust_id is None:
+                logging.warning("Skipping logs without a cust_id, run `manage.py tag-legacy` first")
+                continue
+            newest = self.compact_collection.find_one({"cust_id": cust_id}, {"_id": 0, "time": 1},
+                                                      sort=[("time", -1)])
+            filter_ = {"cust_id": cust_id}
+            if newest is not None:
+                filter_["time"] = {"$gt": newest["time"]}
+            projection = {"_id": 0, "cust_id": 1, "time": 1, "used_amp": 1, "res_amp": 1, "addr": 1, "Name": 1}
+            cursor = source.collection.find(filter_, projection, sort=[("time", ASCENDING)]).batch_size(batch_size)
+            batch = []
+            for document in cursor:
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    migrated += self._migrate_batch(cust_id, batch)
+                    batch = []
+            if batch:
+                migrated += self._migrate_batch(cust_id, batch)
+            logging.info(f"[{cust_id}] Migrated to the compact schema")
+        return migrated
+
+    def _migrate_batch(self, cust_id: str, documents: list) -> int:
+        self.compact_collection.insert_many([self.encode(document) for document in documents], ordered=True)
+        last = documents[-1]
+        metadata = {key: last[key] for key in DORM_FIELDS if last.get(key) is not None}
+        update = {"$max": {"last_time": last["time"]}}
+        if metadata:
+            update["$set"] = metadata
+        self.dorm_collection.update_one({"_id": cust_id}, update, upsert=True)
+        return len(documents)
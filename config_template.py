@@ -1,5 +1,6 @@
 from pytz import timezone
 from datetime import timedelta
+from decimal import Decimal
 
 # School site URL
 BASE_URL: str = 'http://cw.gxjzy.com:8081'
@@ -21,17 +22,121 @@ SID: str = '2023040****'
 # environment variables or encrypted storage.
 PASSWORD: str = '******'
 
+# The login session (cookies and token) is saved to this file and restored at startup, set to None to disable.
+SESSION_FILE: str | None = "session.json"
+# Log in again this long after the last login, before the school site expires the session. None disables it.
+SESSION_REFRESH_INTERVAL: timedelta | None = None
+
 # CUST_ID represents the dormitory ID, not the dormitory number.
 # The specific value depends on the response returned by the school's website.
 CUST_ID: str = "****"
 
+# CUST_IDS lists every dormitory that is polled each TIME_INTERVAL, CUST_ID is the default one used by the API.
+CUST_IDS: list = [CUST_ID]
+
+# Configuration for polling several dormitories
+POLLING_WORKERS: int = 4  # Number of dormitories fetched concurrently
+POLLING_DORM_MIN_INTERVAL = timedelta(minutes=1)  # A dormitory is never polled more often than this
+POLLING_REQUEST_SPACING = timedelta(milliseconds=200)  # Minimum gap between two requests to the school site
+
+# Scheduling mode: "fixed" polls every dormitory each TIME_INTERVAL, "adaptive" learns how often each meter updates
+# and polls shortly after the expected update, backing off while the reading does not change.
+SCHEDULING_MODE: str = "fixed"
+ADAPTIVE_MIN_INTERVAL = timedelta(minutes=2)  # Never poll a dormitory more often than this
+ADAPTIVE_MAX_INTERVAL = timedelta(hours=1)  # Never wait longer than this between two polls
+ADAPTIVE_MARGIN = timedelta(seconds=30)  # Delay after the expected meter update before polling
+# Below ADAPTIVE_LOW_BALANCE res_amp, poll at least every ADAPTIVE_LOW_BALANCE_INTERVAL. None disables it.
+ADAPTIVE_LOW_BALANCE: Decimal | None = Decimal(10)
+ADAPTIVE_LOW_BALANCE_INTERVAL = timedelta(minutes=5)
+
+# A reading fetched from the school site within this window is reused by /get and the scheduler instead of fetching
+# it again. /get?force=true always fetches a new one.
+UPSTREAM_FRESHNESS = timedelta(seconds=30)
+
 # Whether to log dormitory address ID information
 LOGGING_ADDR = False
 
+# Storage backend: "mongodb", or "sqlite" for small deployments without a MongoDB server (e.g. a Raspberry Pi)
+DATABASE_BACKEND: str = "mongodb"
+SQLITE_PATH: str = "electricity.db"  # SQLite database file, ":memory:" keeps everything in memory (for testing)
+
 # MongoDB configuration
 DATABASE_URL: str = "mongodb://localhost:27017"  # MongoDB connection URL
 DATABASE_NAME: str = "electricity"  # Name of the database
 DATABASE_COLLECTION: str = "log"  # Name of the collection for logging
+ROLLUP_COLLECTION: str = "rollup"  # Name of the collection for hourly/daily/monthly consumption rollups
+META_COLLECTION: str = "meta"  # Collection (or SQLite table) holding the data version bumped by manage.py
+
+# Storage schema of the readings:
+# "document" stores every reading as a document of Decimal128 fields in DATABASE_COLLECTION.
+# "compact" stores fixed-point integers in a time-series collection and derives difference/prev_* on read, run
+# `python manage.py migrate-compact` once to copy the existing logs.
+STORAGE_SCHEMA: str = "document"
+COMPACT_COLLECTION: str = "log_ts"  # Time-series collection used by the compact schema
+DORM_COLLECTION: str = "dorm"  # Address, name and latest reading time of every dormitory (compact schema)
+COMPACT_DECIMALS: int = 3  # Decimal places kept by the fixed-point amounts, the site reports two
+
+# MongoDB connection pool configuration
+# A single client is shared by the whole process, these values control its pool.
+DATABASE_MAX_POOL_SIZE: int = 10  # Maximum number of pooled connections
+DATABASE_MIN_POOL_SIZE: int = 0  # Minimum number of idle connections kept open
+DATABASE_SERVER_SELECTION_TIMEOUT_MS: int = 5000  # How long to wait for an available server
+DATABASE_CONNECT_TIMEOUT_MS: int = 5000  # Timeout for establishing a new connection
+DATABASE_SOCKET_TIMEOUT_MS: int = 10000  # Timeout for a single database operation
+
+# Readings are first appended to this journal file and then flushed to the database in batches, so they are not lost
+# while MongoDB is slow or down. Set to None to insert readings directly.
+JOURNAL_FILE: str | None = "journal.ndjson"
+JOURNAL_FSYNC: bool = True  # fsync the journal after every append, safer but slower on SD cards
+JOURNAL_BATCH_SIZE: int = 500  # Number of readings per insert_many when flushing the journal
+JOURNAL_FLUSH_INTERVAL = timedelta(minutes=1)  # How often the backlog is retried while the database is down
+
+# Number of logs fetched from the database per round-trip when exporting or streaming logs
+LOGS_BATCH_SIZE: int = 1000
+# Maximum page size accepted by /logs_by_filter
+LOGS_FILTER_MAX_LIMIT: int = 1000
+# Maximum number of points /series may return
+SERIES_MAX_POINTS: int = 5000
+
+# Cache-Control of / and /logs. Both answer If-None-Match/If-Modified-Since with 304 until a new reading is stored,
+# so a short max-age only bounds how long a proxy serves a response without asking. The access_token of /logs is part
+# of the URL and therefore of a shared cache's key.
+ROOT_CACHE_CONTROL: str = "public, max-age=30"
+LOGS_CACHE_CONTROL: str = "public, max-age=30"
+# manage.py commands that change stored readings bump a data version in the database, which is part of the ETag and
+# Last-Modified. A running server rereads it at most this often, so validators change this long after an offline
+# import or recompute without a restart.
+DATA_VERSION_REFRESH: timedelta = timedelta(seconds=30)
+
+# `python manage.py recompute-deltas`
+RECOMPUTE_CHECKPOINT_FILE: str | None = "recompute_checkpoint.json"  # Progress of an interrupted run, None to disable
+RECOMPUTE_MAX_GAP = TIME_INTERVAL * 3  # Longer intervals between two readings are reported as gaps
+RECOMPUTE_RECHARGE_THRESHOLD: Decimal = Decimal(1)  # A res_amp increase of at least this is reported as a recharge
+
+# Alerts evaluated on every stored reading
+ALERT_LOW_BALANCE: Decimal | None = Decimal(10)  # Alert when res_amp falls below this, None disables the rule
+ALERT_LOW_BALANCE_RECOVERY: Decimal = Decimal(5)  # res_amp must rise this far above the threshold to alert again
+# Alert when the hourly consumption is this many standard deviations above its moving average, None disables it
+ALERT_SPIKE_Z_SCORE: float | None = 4.0
+ALERT_SPIKE_ALPHA: float = 0.05  # Weight of the newest reading in the moving average and variance
+ALERT_SPIKE_MIN_SAMPLES: int = 24  # Readings needed before spikes are reported
+ALERT_SPIKE_MIN_RATE: float = 0.5  # Hourly consumption below this is never a spike
+ALERT_COOLDOWN = timedelta(hours=6)  # The same alert of a dormitory is sent at most once per cool-down
+ALERT_QUEUE_SIZE: int = 100  # Alerts waiting for the notifiers, further alerts are dropped
+# Notifiers, all configured ones receive every alert
+ALERT_WEBHOOK_URL: str | None = None  # The alert is POSTed as JSON
+ALERT_FILE: str | None = None  # The alert is appended as one JSON line
+ALERT_COMMAND: list | None = None  # e.g. ["notify-send", "Electricity"], the alert is passed on stdin and as ALERT_*
+
+# Server-Sent Events on /stream
+STREAM_QUEUE_SIZE: int = 16  # Events buffered per client, a slow client loses its oldest events beyond this
+STREAM_MAX_CLIENTS: int = 500  # Further clients are refused with 503
+STREAM_HEARTBEAT = timedelta(seconds=15)  # Comment sent to idle clients so proxies keep the connection open
+
+# Depletion forecast served by /forecast
+FORECAST_WINDOW = timedelta(days=28)  # History used to learn the hourly consumption profile
+FORECAST_HALF_LIFE = timedelta(days=7)  # Readings this old weigh half as much as the latest ones
+FORECAST_HORIZON = timedelta(days=90)  # Forecasts beyond this are reported as unknown
 
 # Access token for authentication (optional, API is unauthenticated if not provided)
 # WARNING: It's not recommended to leave ACCESS_TOKEN unset for production environments.
@@ -41,6 +146,10 @@ ACCESS_TOKEN: str = "ACCESS_TOKEN"
 # Configuration for FastAPI (WebAPI) port
 PORT = 8088  # Change this port number if necessary
 
+# Size of the thread pools the API uses for blocking I/O
+UPSTREAM_WORKERS: int = 4  # Requests to the school site
+DATABASE_WORKERS: int = 16  # Database queries, should not exceed DATABASE_MAX_POOL_SIZE by much
+
 LOGGING_CONFIG: dict = {
     'version': 1,
     'disable_existing_loggers': False,
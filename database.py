@@ -0,0 +1,211 @@
+import logging
+import threading
+from datetime import datetime
+
+from pymongo import ASCENDING, MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from config import *
+
+
+class LogRepository(object):
+    def __init__(self, url: str, database_name: str, collection_name: str, rollup_collection_name: str = "rollup",
+                 meta_collection_name: str = "meta", **client_options):
+        self.url: str = url
+        self.database_name: str = database_name
+        self.collection_name: str = collection_name
+        self.rollup_collection_name: str = rollup_collection_name
+        self.client_options: dict = client_options
+        self.meta_collection_name: str = meta_collection_name
+        self.client: MongoClient | None = None
+        self._lock = threading.Lock()
+
+    def connect(self) -> MongoClient:
+        # MongoClient is thread-safe and keeps its own connection pool, so one instance is shared by the
+        # scheduler thread and every request handler.
+        with self._lock:
+            if self.client is None:
+                self.client = MongoClient(self.url, **self.client_options)
+                logging.info(f"MongoDB client created for {self.database_name}.{self.collection_name}")
+            return self.client
+
+    def close(self):
+        with self._lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+                logging.info("MongoDB client closed")
+
+    @property
+    def database(self):
+        return self.connect()[self.database_name]
+
+    @property
+    def collection(self):
+        return self.database[self.collection_name]
+
+    @property
+    def rollup_collection(self):
+        return self.database[self.rollup_collection_name]
+
+    @property
+    def meta_collection(self):
+        return self.database[self.meta_collection_name]
+
+    def ensure_indexes(self):
+        # (cust_id, time) is unique: it deduplicates readings and serves per-dormitory range queries and "latest
+        # reading" lookups. (time, _id) serves range queries across all dormitories without a blocking sort.
+        self.collection.create_index([("cust_id", ASCENDING), ("time", ASCENDING)], name="cust_id_time",
+                                     unique=True)
+        self.collection.create_index([("time", ASCENDING), ("_id", ASCENDING)], name="time")
+        self.rollup_collection.create_index([("cust_id", ASCENDING), ("period", ASCENDING), ("start", ASCENDING)],
+                                            name="cust_id_period_start", unique=True)
+
+    def find_logs(self, filter_: dict = None, projection: dict = None, sort: list = None, limit: int = 0):
+        return self.collection.find(filter_ or {}, projection, sort=sort).limit(limit if limit > 0 else 0)
+
+    def insert_log(self, document: dict):
+        return self.collection.insert_one(document)
+
+    def upsert_log(self, document: dict):
+        """Insert ``document`` unless a log with the same cust_id and time exists, returns None for duplicates."""
+        try:
+            result = self.collection.update_one({"cust_id": document["cust_id"], "time": document["time"]},
+                                                {"$setOnInsert": document}, upsert=True)
+        except DuplicateKeyError:
+            # Two concurrent upserts of the same reading, the other one won.
+            return None
+        return result if result.upserted_id is not None else None
+
+    def insert_logs(self, documents: list) -> list:
+        """Insert ``documents`` in one unordered batch, returns for each one whether it was new."""
+        if not documents:
+            return []
+        inserted = [True] * len(documents)
+        try:
+            self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as err:
+            for error in err.details.get("writeErrors", []):
+                if error.get("code") != 11000:
+                    raise
+                inserted[error["index"]] = False
+        return inserted
+
+    def update_logs(self, updates: list) -> int:
+        """Apply ``updates`` ([(_id, {field: value})]) in one unordered bulk write, returns the number modified."""
+        if not updates:
+            return 0
+        result = self.collection.bulk_write([UpdateOne({"_id": _id}, {"$set": fields}) for _id, fields in updates],
+                                            ordered=False)
+        return result.modified_count
+
+    def increment_rollups(self, cust_id: str, starts: dict, used_amp, res_amp):
+        """Add one reading to the rollup of every period in ``starts`` ({period: period start})."""
+        operations = [
+            UpdateOne({"cust_id": cust_id, "period": period, "start": start},
+                      {"$inc": {"used": used_amp, "count": 1},
+                       "$min": {"min_res_amp": res_amp},
+                       "$max": {"max_res_amp": res_amp}},
+                      upsert=True)
+            for period, start in starts.items()
+        ]
+        return self.rollup_collection.bulk_write(operations, ordered=False)
+
+    def find_rollups(self, cust_id: str, period: str, start=None, end=None, limit: int = 0, ascending_order=False):
+        filter_ = {"cust_id": cust_id, "period": period}
+        if start is not None or end is not None:
+            filter_["start"] = {key: value for key, value in (("$gte", start), ("$lte", end)) if value is not None}
+        projection = {"_id": 0, "cust_id": 0, "period": 0}
+        return self.rollup_collection.find(filter_, projection, sort=[("start", 1 if ascending_order else -1)]) \
+            .limit(limit if limit > 0 else 0)
+
+    def find_series(self, cust_id: str, field: str, start=None, end=None, batch_size: int = 10000):
+        """Yield ``{"t": epoch milliseconds, "v": float}`` of ``field`` in time order, converted by the server."""
+        match = {"cust_id": cust_id, field: {"$ne": None}}
+        if start is not None or end is not None:
+            match["time"] = {key: value for key, value in (("$gte", start), ("$lte", end)) if value is not None}
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"time": 1}},
+            {"$project": {"_id": 0, "t": {"$toLong": "$time"}, "v": {"$toDouble": f"${field}"}}}
+        ]
+        return self.collection.aggregate(pipeline, batchSize=batch_size)
+
+    def rebuild_rollups(self, period: str, timezone_name: str, cust_id: str = None):
+        """Recompute the rollups of ``period`` from the raw logs with one aggregation per period."""
+        match = {} if cust_id is None else {"cust_id": cust_id}
+        self.rollup_collection.delete_many(dict(match, period=period))
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": {"cust_id": "$cust_id",
+                        "start": {"$dateTrunc": {"date": "$time", "unit": period, "timezone": timezone_name}}},
+                "used": {"$sum": "$prev_used_amp"},
+                "count": {"$sum": 1},
+                "min_res_amp": {"$min": "$res_amp"},
+                "max_res_amp": {"$max": "$res_amp"}
+            }},
+            {"$project": {"_id": 0, "cust_id": "$_id.cust_id", "period": {"$literal": period}, "start": "$_id.start",
+                          "used": 1, "count": 1, "min_res_amp": 1, "max_res_amp": 1}},
+            {"$merge": {"into": self.rollup_collection_name, "on": ["cust_id", "period", "start"],
+                        "whenMatched": "replace", "whenNotMatched": "insert"}}
+        ]
+        self.collection.aggregate(pipeline, allowDiskUse=True)
+
+    def data_version(self) -> tuple:
+        """(version, time of the last bump) of the stored data, (0, None) until it was first bumped."""
+        document = self.meta_collection.find_one({"_id": "data_version"})
+        return (document["version"], document["time"]) if document is not None else (0, None)
+
+    def bump_data_version(self):
+        """Record that readings or rollups were changed outside of the running server."""
+        self.meta_collection.update_one({"_id": "data_version"},
+                                        {"$inc": {"version": 1}, "$set": {"time": datetime.utcnow()}}, upsert=True)
+
+
+_repository: LogRepository | None = None
+_repository_lock = threading.Lock()
+
+
+def get_repository() -> LogRepository:
+    global _repository
+    if _repository is None:
+        with _repository_lock:
+            if _repository is None:
+                client_options = dict(
+                    maxPoolSize=DATABASE_MAX_POOL_SIZE,
+                    minPoolSize=DATABASE_MIN_POOL_SIZE,
+                    serverSelectionTimeoutMS=DATABASE_SERVER_SELECTION_TIMEOUT_MS,
+                    connectTimeoutMS=DATABASE_CONNECT_TIMEOUT_MS,
+                    socketTimeoutMS=DATABASE_SOCKET_TIMEOUT_MS
+                )
+                if DATABASE_BACKEND == "sqlite":
+                    from sqlite_repository import SQLiteLogRepository
+                    _repository = SQLiteLogRepository(SQLITE_PATH, DATABASE_COLLECTION, ROLLUP_COLLECTION,
+                                                      META_COLLECTION)
+                elif STORAGE_SCHEMA == "compact":
+                    from compact import CompactLogRepository
+                    _repository = CompactLogRepository(
+                        DATABASE_URL, DATABASE_NAME, DATABASE_COLLECTION, ROLLUP_COLLECTION, COMPACT_COLLECTION,
+                        DORM_COLLECTION, COMPACT_DECIMALS, META_COLLECTION, **client_options)
+                else:
+                    _repository = LogRepository(DATABASE_URL, DATABASE_NAME, DATABASE_COLLECTION, ROLLUP_COLLECTION,
+                                                META_COLLECTION, **client_options)
+    return _repository
+
+
+def set_repository(repository: LogRepository):
+    """Replace the process-wide repository, e.g. to point the benchmarks at a scratch database."""
+    global _repository
+    with _repository_lock:
+        if _repository is not None and _repository is not repository:
+            _repository.close()
+        _repository = repository
+
+
+def close_repository():
+    global _repository
+    with _repository_lock:
+        if _repository is not None:
+            _repository.close()
+            _repository = None
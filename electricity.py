@@ -1,22 +1,28 @@
+import base64
+import json
 import logging
+import threading
+import time
 from datetime import datetime
 from decimal import Decimal, InvalidOperation
 
 from bson.decimal128 import Decimal128
-from pymongo import MongoClient
+from bson.objectid import ObjectId
 from pytz import utc
 
 from config import *
+from database import get_repository
+from journal import JournalEntry, WriteAheadJournal
+from metrics import DATABASE_SECONDS, READINGS_TOTAL
 
 
 class ElectricityInfo(object):
-    def __init__(self, data: dict):
+    def __init__(self, data: dict, cust_id: str = None):
         if not (data['success'] and data['state'] != 200):
             pass
-        self.collection = MongoClient(DATABASE_URL)[DATABASE_NAME][DATABASE_COLLECTION]
         try:
+            self.cust_id: str = str(cust_id if cust_id is not None else data["data"]["Id"])
             if LOGGING_ADDR:
-                self.cust_id: str = data["data"]["Id"]
                 self.addr: str = data["data"]["Addr"]
                 self.name: str = data["data"]["Name"]
             self.used_amp: Decimal = Decimal(data["data"]["Usedamp"])
@@ -28,10 +34,10 @@ class ElectricityInfo(object):
             self.time: datetime = TIMEZONE.localize(datetime.strptime(data["data"]["Time"], '%Y/%m/%d %H:%M:%S'))
             self.raw_data: dict = data
             try:
-                last_log = get_logs()
+                last_log = latest_logs.get(self.cust_id)
                 if last_log:
-                    self.prev_used_amp = self.used_amp - last_log[0]['used_amp']
-                    self.prev_res_amp = self.res_amp - last_log[0]['res_amp']
+                    self.prev_used_amp = self.used_amp - last_log['used_amp']
+                    self.prev_res_amp = self.res_amp - last_log['res_amp']
                     if self.prev_used_amp != Decimal(0) and self.prev_res_amp != Decimal(0):
                         self.prev_ratio = self.prev_used_amp / abs(self.prev_res_amp)
                 else:
@@ -43,15 +49,36 @@ class ElectricityInfo(object):
                 self.prev_ratio = Decimal(0)
                 logging.error(e)
                 pass
+            except Exception as e:
+                # The database is down and the cache is cold: the reading must still reach the journal.
+                logging.error(f"[{self.cust_id}] Failed to load the previous reading, deltas are left at 0: {e}")
         except KeyError as e:
             logging.error(e)
             pass
 
     def insert2db(self):
         try:
-            if not get_logs() or (self.prev_res_amp != Decimal(0) and self.prev_used_amp != Decimal(0)):
-                return self.collection.insert_one(self.to_dict(True))
-            return None
+            if journal is not None:
+                # The reading is durable once it is in the journal, later readings compute their deltas against it
+                # even while the database is down.
+                with DATABASE_SECONDS.time(operation="journal_append"):
+                    entry = journal.append(self.to_dict())
+                with DATABASE_SECONDS.time(operation="journal_flush"):
+                    journal.flush(notify_inserted)
+                if entry.inserted is None:
+                    # Inserted readings reach the cache through notify_inserted. A buffered one only replaces a
+                    # strictly older reading: a re-poll of an unchanged meter carries zero deltas.
+                    latest_logs.update(self.to_dict(), newer_only=True)
+                READINGS_TOTAL.inc(result="buffered" if entry.inserted is None else
+                                   "inserted" if entry.inserted else "duplicate")
+                # A buffered entry is returned too, is_buffered() tells it apart from an inserted one.
+                return entry if entry.inserted is not False else None
+            with DATABASE_SECONDS.time(operation="insert"):
+                result = get_repository().upsert_log(self.to_dict(True))
+            READINGS_TOTAL.inc(result="inserted" if result is not None else "duplicate")
+            if result is not None:
+                notify_inserted(self.to_dict())
+            return result
         except AttributeError:
             return None
 
@@ -63,10 +90,10 @@ class ElectricityInfo(object):
             prev_used_amp=self.prev_used_amp,
             prev_res_amp=self.prev_res_amp,
             prev_ratio=self.prev_ratio,
-            time=self.time
+            time=self.time,
+            cust_id=self.cust_id
         )
         if LOGGING_ADDR:
-            dict_data['cust_id'] = self.cust_id
             dict_data['addr'] = self.addr
             dict_data['Name'] = self.name
         if to_db:
@@ -76,30 +103,269 @@ class ElectricityInfo(object):
         return dict_data
 
 
-def get_logs(limit=1, ascending_order=False, projection=None):
-    sort_order = [('_id', 1)] if ascending_order else [('_id', -1)]
-    projection = {
-        "_id": 0,
-        "used_amp": 1,
-        "res_amp": 1,
-        "difference": 1,
-        "time": 1,
-        "prev_used_amp": 1,
-        "prev_res_amp": 1,
-        "prev_ratio": 1
-    } if projection is None else projection
-
-    with MongoClient(DATABASE_URL) as client:
-        collection = client[DATABASE_NAME][DATABASE_COLLECTION]
-        cursor = collection.find({}, projection, sort=sort_order).limit(limit if limit > 0 else 0)
-
-        logs = []
+def is_buffered(result) -> bool:
+    """Whether ``result`` of insert2db is a reading waiting in the journal because the database is unavailable."""
+    return isinstance(result, JournalEntry) and result.inserted is None
+
+
+LOG_PROJECTION: dict = {
+    "_id": 0,
+    "cust_id": 1,
+    "used_amp": 1,
+    "res_amp": 1,
+    "difference": 1,
+    "time": 1,
+    "prev_used_amp": 1,
+    "prev_res_amp": 1,
+    "prev_ratio": 1
+}
+
+
+def decode_log(log: dict) -> dict:
+    for key, value in log.items():
+        if isinstance(value, Decimal128):
+            log[key] = value.to_decimal()
+        if isinstance(value, datetime):
+            log[key] = utc.localize(value).astimezone(TIMEZONE)
+    return log
+
+
+def log_fields(projection: dict = None) -> list:
+    projection = LOG_PROJECTION if projection is None else projection
+    return sorted([key for key, value in projection.items() if value and key != "_id"],
+                  key=lambda x: (x != "time", x))
+
+
+def log_sort(ascending_order=False, cust_id=None) -> list:
+    direction = 1 if ascending_order else -1
+    # time is unique per cust_id, so the _id tie-breaker is only needed (and only indexed) across dormitories.
+    if cust_id is not None:
+        return [('time', direction)]
+    return [('time', direction), ('_id', direction)]
+
+
+def build_log_filter(cust_id=None, start: datetime = None, end: datetime = None,
+                     min_res_amp: Decimal = None, max_res_amp: Decimal = None,
+                     min_prev_used_amp: Decimal = None, max_prev_used_amp: Decimal = None) -> dict:
+    filter_ = {}
+    if cust_id is not None:
+        filter_["cust_id"] = str(cust_id)
+    ranges = (("time", start, end), ("res_amp", min_res_amp, max_res_amp),
+              ("prev_used_amp", min_prev_used_amp, max_prev_used_amp))
+    for key, lower, upper in ranges:
+        condition = {}
+        if lower is not None:
+            condition["$gte"] = Decimal128(Decimal(str(lower))) if key != "time" else lower
+        if upper is not None:
+            condition["$lte"] = Decimal128(Decimal(str(upper))) if key != "time" else upper
+        if condition:
+            filter_[key] = condition
+    return filter_
+
+
+def encode_cursor(log: dict) -> str:
+    raw = json.dumps({"time": log["time"].isoformat(), "id": str(log["_id"])})
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor: str, ascending_order=False) -> dict:
+    """Turn a cursor returned by ``find_logs_page`` into the filter selecting the logs after it."""
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))
+        time = datetime.fromisoformat(raw["time"])
+        # ObjectIds from MongoDB, integer row ids from SQLite.
+        _id = ObjectId(raw["id"]) if ObjectId.is_valid(raw["id"]) else int(raw["id"])
+    except (ValueError, KeyError, TypeError) as err:
+        raise ValueError(f"Invalid cursor: {cursor}") from err
+    operator = "$gt" if ascending_order else "$lt"
+    return {"$or": [{"time": {operator: time}}, {"time": time, "_id": {operator: _id}}]}
+
+
+def find_logs_page(filter_: dict, limit=100, ascending_order=False, cursor: str = None) -> tuple:
+    """Return one page of logs matching ``filter_`` and the cursor of the next page (None on the last page)."""
+    sort_order = log_sort(ascending_order, filter_.get("cust_id"))
+    if cursor:
+        filter_ = {"$and": [filter_, decode_cursor(cursor, ascending_order)]}
+    projection = dict(LOG_PROJECTION, _id=1)
+    # One extra log is fetched to know whether another page exists.
+    documents = list(get_repository().find_logs(filter_, projection, sort=sort_order, limit=limit + 1))
+    next_cursor = encode_cursor(documents[limit - 1]) if len(documents) > limit else None
+    logs = []
+    for log in documents[:limit]:
+        del log["_id"]
+        logs.append(decode_log(log))
+    return logs, next_cursor
+
+
+def iter_logs(limit=1, ascending_order=False, projection=None, cust_id=None, batch_size=LOGS_BATCH_SIZE):
+    sort_order = log_sort(ascending_order, cust_id)
+    projection = LOG_PROJECTION if projection is None else projection
+
+    filter_ = build_log_filter(cust_id)
+    cursor = get_repository().find_logs(filter_, projection, sort=sort_order, limit=limit).batch_size(batch_size)
+    try:
         for log in cursor:
-            for key, value in log.items():
-                if isinstance(value, Decimal128):
-                    log[key] = Decimal(str(value))
-                if isinstance(value, datetime):
-                    log[key] = utc.localize(value).astimezone(TIMEZONE)
-            logs.append(log)
-
-    return logs
+            yield decode_log(log)
+    finally:
+        cursor.close()
+
+
+def get_logs(limit=1, ascending_order=False, projection=None, cust_id=None):
+    with DATABASE_SECONDS.time(operation="get_logs"):
+        return list(iter_logs(limit, ascending_order, projection, cust_id))
+
+
+_insert_listeners: list = []
+
+
+def add_insert_listener(listener):
+    """Register ``listener(log)`` to be called with the decoded log after every successful insert."""
+    _insert_listeners.append(listener)
+
+
+def notify_inserted(log: dict):
+    for listener in _insert_listeners:
+        try:
+            listener(dict(log))
+        except Exception as err:
+            logging.error(f"Insert listener {getattr(listener, '__name__', listener)} failed: {err}")
+
+
+class LatestLogCache(object):
+    """Keeps the last stored log of each cust_id in memory, the database is only queried on a cache miss."""
+
+    def __init__(self, cust_ids: list = ()):
+        self._logs: dict = {}
+        self._lock = threading.Lock()
+        # "No logs" is only remembered for polled dormitories, so arbitrary ids passed to / cannot grow the cache.
+        self._known: set = {str(cust_id) for cust_id in cust_ids}
+
+    def get(self, cust_id) -> dict | None:
+        cust_id = str(cust_id)
+        with self._lock:
+            if cust_id in self._logs:
+                log = self._logs[cust_id]
+                return dict(log) if log is not None else None
+        logs = get_logs(cust_id=cust_id)
+        log = logs[0] if logs else None
+        with self._lock:
+            if log is not None or cust_id in self._known:
+                # An insert may have landed while the database was queried, it always wins over the loaded value.
+                self._logs.setdefault(cust_id, log)
+            log = self._logs.get(cust_id, log)
+        return dict(log) if log is not None else None
+
+    def update(self, log: dict, newer_only: bool = False):
+        fields = log_fields()
+        log = {key: value for key, value in log.items() if key in fields}
+        cust_id = str(log["cust_id"])
+        with self._lock:
+            current = self._logs.get(cust_id)
+            if current is None or current["time"] < log["time"] or \
+                    (not newer_only and current["time"] == log["time"]):
+                self._logs[cust_id] = log
+
+    def last_modified(self, cust_id=None) -> datetime | None:
+        """Time of the latest reading of ``cust_id``, or of any cached dormitory when None."""
+        if cust_id is not None:
+            log = self.get(cust_id)
+            return log["time"] if log is not None else None
+        with self._lock:
+            times = [log["time"] for log in self._logs.values() if log is not None]
+        return max(times) if times else None
+
+    def warm(self, cust_ids: list):
+        for cust_id in cust_ids:
+            self.invalidate(cust_id)
+            self.get(cust_id)
+
+    def invalidate(self, cust_id=None):
+        with self._lock:
+            if cust_id is None:
+                self._logs.clear()
+            else:
+                self._logs.pop(str(cust_id), None)
+
+
+class StoreTimes(object):
+    """
+    Wall-clock time of the latest stored insert, of each cust_id and overall. Unlike the meter time of the latest
+    reading it moves on every insert, also of a reading older than another dormitory's latest one.
+    """
+
+    def __init__(self):
+        self._times: dict = {}
+        self._last: datetime | None = None
+        self._lock = threading.Lock()
+
+    def record(self, log: dict):
+        now = datetime.now(utc)
+        with self._lock:
+            self._times[str(log["cust_id"])] = now
+            self._last = now
+
+    def get(self, cust_id=None) -> datetime | None:
+        with self._lock:
+            return self._last if cust_id is None else self._times.get(str(cust_id))
+
+
+class DataVersion(object):
+    """
+    The data version that manage.py bumps after changing stored readings or rollups, reread from the database at
+    most once per ``refresh``. ``on_change`` is called when another process bumped it.
+    """
+
+    def __init__(self, refresh: timedelta, on_change=None):
+        self.refresh: float = refresh.total_seconds()
+        self.on_change = on_change
+        self._version: tuple | None = None
+        self._read_at: float = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> tuple:
+        """(version, time of the last bump as an aware datetime or None)."""
+        with self._lock:
+            if self._version is not None and time.monotonic() - self._read_at < self.refresh:
+                return self._version
+        try:
+            version, bumped_at = get_repository().data_version()
+        except Exception as err:
+            logging.warning(f"Failed to read the data version: {err}")
+            with self._lock:
+                return self._version if self._version is not None else (0, None)
+        version = (version, utc.localize(bumped_at).astimezone(TIMEZONE) if bumped_at is not None else None)
+        with self._lock:
+            changed = self._version is not None and self._version != version
+            self._version = version
+            self._read_at = time.monotonic()
+        if changed and self.on_change is not None:
+            logging.info(f"Data version changed to {version[0]}")
+            self.on_change()
+        return version
+
+
+latest_logs = LatestLogCache(CUST_IDS)
+add_insert_listener(latest_logs.update)
+# Only notify_inserted calls the listeners, so readings buffered in the journal do not count until they are stored.
+store_times = StoreTimes()
+add_insert_listener(store_times.record)
+
+journal: WriteAheadJournal | None = WriteAheadJournal(JOURNAL_FILE, JOURNAL_FSYNC, JOURNAL_BATCH_SIZE) \
+    if JOURNAL_FILE is not None else None
+
+
+def seed_latest_logs():
+    """Put the readings still in the journal into the latest log cache, they are newer than anything stored."""
+    if journal is not None:
+        for log in journal.pending_logs():
+            latest_logs.update(log, newer_only=True)
+
+
+def reload_latest_logs():
+    latest_logs.invalidate()
+    seed_latest_logs()
+
+
+seed_latest_logs()
+# Offline imports may have stored newer readings than the cached ones.
+data_version = DataVersion(DATA_VERSION_REFRESH, reload_latest_logs)
@@ -0,0 +1,112 @@
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from config import *
+from electricity import latest_logs
+from rollups import get_rollups
+from series import load_series
+
+HOURS_PER_WEEK: int = 7 * 24
+MILLISECONDS_PER_HOUR: int = 3600 * 1000
+
+
+def hourly_usage(cust_id: str, start: datetime) -> tuple:
+    """Return (UTC hours since the epoch, consumption in that hour), from the hourly rollups when they exist."""
+    rollups = get_rollups(cust_id, "hour", start=start, ascending_order=True)
+    if rollups:
+        hours = np.fromiter((int(rollup["start"].timestamp()) // 3600 for rollup in rollups), dtype=np.int64,
+                            count=len(rollups))
+        used = np.fromiter((float(rollup["used"]) for rollup in rollups), dtype=np.float64, count=len(rollups))
+        return hours, used
+    # No rollups yet (e.g. never rebuilt), aggregate the raw readings instead.
+    x, y = load_series(cust_id, "prev_used_amp", start)
+    if len(x) == 0:
+        return x, y
+    hours, inverse = np.unique(x // MILLISECONDS_PER_HOUR, return_inverse=True)
+    return hours, np.bincount(inverse, weights=y)
+
+
+def hour_of_week(hours: np.ndarray, utc_offset_hours: int) -> np.ndarray:
+    local_hours = hours + utc_offset_hours
+    # 1970-01-01 was a Thursday, weekday() == 3.
+    return ((local_hours // 24 + 3) % 7) * 24 + local_hours % 24
+
+
+def consumption_profile(hours: np.ndarray, used: np.ndarray, now_hour: int, utc_offset_hours: int,
+                        half_life_hours: float) -> np.ndarray:
+    """Expected consumption of each hour of the week, recent weeks weigh more than older ones."""
+    used = np.clip(used, 0, None)
+    weights = 0.5 ** ((now_hour - hours) / half_life_hours)
+    slots = hour_of_week(hours, utc_offset_hours)
+    weighted_used = np.bincount(slots, weights=used * weights, minlength=HOURS_PER_WEEK)
+    weight_sums = np.bincount(slots, weights=weights, minlength=HOURS_PER_WEEK)
+    overall = weighted_used.sum() / weight_sums.sum()
+    # Hours of the week that were never observed fall back to the overall hourly mean.
+    return np.where(weight_sums > 0, weighted_used / np.where(weight_sums > 0, weight_sums, 1), overall)
+
+
+def hours_until_depleted(balance: float, profile: np.ndarray, start_slot: int, horizon_hours: int) -> float | None:
+    if balance <= 0:
+        return 0.0
+    rates = profile[(start_slot + np.arange(horizon_hours)) % HOURS_PER_WEEK]
+    consumed = np.cumsum(rates)
+    index = int(np.searchsorted(consumed, balance))
+    if index >= horizon_hours:
+        return None
+    before = consumed[index - 1] if index > 0 else 0.0
+    return index + (balance - before) / rates[index]
+
+
+class DepletionForecast(object):
+    """Caches one forecast per cust_id, recomputed only when a newer reading has been stored."""
+
+    def __init__(self, window: timedelta, half_life: timedelta, horizon: timedelta):
+        self.window: timedelta = window
+        self.half_life_hours: float = half_life.total_seconds() / 3600
+        self.horizon_hours: int = int(horizon.total_seconds() // 3600)
+        self._forecasts: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, cust_id: str) -> dict | None:
+        cust_id = str(cust_id)
+        last_log = latest_logs.get(cust_id)
+        if last_log is None:
+            return None
+        with self._lock:
+            cached = self._forecasts.get(cust_id)
+        if cached is not None and cached[0] == last_log["time"]:
+            return dict(cached[1])
+        forecast = self.compute(cust_id, last_log)
+        with self._lock:
+            self._forecasts[cust_id] = (last_log["time"], forecast)
+        return dict(forecast)
+
+    def compute(self, cust_id: str, last_log: dict) -> dict:
+        now = last_log["time"].astimezone(TIMEZONE)
+        hours, used = hourly_usage(cust_id, now - self.window)
+        result = {
+            "cust_id": cust_id,
+            "res_amp": last_log["res_amp"],
+            "time": now,
+            "samples": int(len(hours)),
+            "hourly_rate": None,
+            "hours_remaining": None,
+            "depleted_at": None
+        }
+        if len(hours) == 0 or used.sum() <= 0:
+            return result
+        utc_offset_hours = int(now.utcoffset().total_seconds() // 3600)
+        now_hour = int(now.timestamp()) // 3600
+        profile = consumption_profile(hours, used, now_hour, utc_offset_hours, self.half_life_hours)
+        start_slot = int(hour_of_week(np.array([now_hour]), utc_offset_hours)[0])
+        remaining = hours_until_depleted(float(last_log["res_amp"]), profile, start_slot, self.horizon_hours)
+        result["hourly_rate"] = float(profile[(start_slot + np.arange(24)) % HOURS_PER_WEEK].mean())
+        if remaining is not None:
+            result["hours_remaining"] = round(remaining, 2)
+            result["depleted_at"] = now + timedelta(hours=remaining)
+        return result
+
+
+depletion_forecast = DepletionForecast(FORECAST_WINDOW, FORECAST_HALF_LIFE, FORECAST_HORIZON)
@@ -0,0 +1,197 @@
+import csv
+import json
+import logging
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from bson.decimal128 import Decimal128
+
+from config import *
+from database import get_repository
+from electricity import decode_log
+from recompute import compute_deltas
+
+IMPORT_FORMATS: tuple = ("csv", "ndjson")
+
+
+def detect_format(path: str) -> str:
+    return "ndjson" if path.lower().endswith((".ndjson", ".jsonl", ".json")) else "csv"
+
+
+def read_rows(file, file_format: str):
+    """Yield the rows of an export of /logs (CSV with a header line or one JSON object per line) one at a time."""
+    if file_format == "csv":
+        yield from csv.DictReader(file)
+    elif file_format == "ndjson":
+        for line in file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    else:
+        raise ValueError(f"Unknown format: {file_format}")
+
+
+def parse_time(value) -> datetime:
+    time = value if isinstance(value, datetime) else datetime.fromisoformat(str(value).strip())
+    # CSV exports contain local times without an offset.
+    return TIMEZONE.localize(time) if time.tzinfo is None else time
+
+
+def parse_reading(row: dict, default_cust_id: str = None) -> dict:
+    cust_id = row.get("cust_id") or default_cust_id
+    if cust_id is None:
+        raise ValueError("missing cust_id")
+    reading = {
+        "cust_id": str(cust_id),
+        "time": parse_time(row["time"]),
+        "used_amp": Decimal(str(row["used_amp"])),
+        "res_amp": Decimal(str(row["res_amp"]))
+    }
+    if LOGGING_ADDR:
+        for key in ("addr", "Name"):
+            if row.get(key) is not None:
+                reading[key] = row[key]
+    return reading
+
+
+class DormImportState(object):
+    def __init__(self):
+        # 1 when the dormitory's rows are in ascending time order, -1 when descending, 0 until the second row.
+        self.direction: int = 0
+        self.last: dict | None = None
+        # Time range of the imported readings, the stored ones inside and right after it are re-derived.
+        self.oldest: datetime | None = None
+        self.newest: datetime | None = None
+
+
+class LogImporter(object):
+    """
+    Imports readings in one pass with memory bounded by the batch size and the number of dormitories: only the last
+    row of each dormitory is kept to compute the deltas of the next one. The rows of a dormitory must be in time
+    order, ascending or descending (as /logs exports them), rows of different dormitories may be interleaved.
+    """
+
+    def __init__(self, batch_size: int = 1000, default_cust_id: str = None):
+        self.batch_size: int = max(1, batch_size)
+        self.default_cust_id: str | None = default_cust_id
+        self.repository = get_repository()
+        self.stats: dict = {"read": 0, "inserted": 0, "duplicate": 0, "invalid": 0, "out_of_order": 0,
+                            "rederived": 0}
+        self._states: dict = {}
+        self._batch: list = []
+
+    @property
+    def cust_ids(self) -> list:
+        return sorted(self._states)
+
+    def import_file(self, path: str, file_format: str = None) -> dict:
+        file_format = file_format or detect_format(path)
+        with open(path, newline='' if file_format == "csv" else None, encoding='utf-8') as file:
+            for line_number, row in enumerate(read_rows(file, file_format), start=1):
+                self.stats["read"] += 1
+                try:
+                    reading = parse_reading(row, self.default_cust_id)
+                except (KeyError, ValueError, TypeError, InvalidOperation) as err:
+                    self.stats["invalid"] += 1
+                    logging.warning(f"{path}:{line_number}: skipping invalid row ({err!r})")
+                    continue
+                self.add(reading)
+        return self.stats
+
+    def add(self, reading: dict):
+        state = self._states.setdefault(reading["cust_id"], DormImportState())
+        last = state.last
+        if last is None:
+            state.last = reading
+            return
+        if reading["time"] == last["time"]:
+            self.stats["duplicate"] += 1
+            return
+        if state.direction == 0:
+            state.direction = 1 if reading["time"] > last["time"] else -1
+            if state.direction == 1:
+                self._emit(last, self._stored_before(last))
+        if (reading["time"] > last["time"]) != (state.direction == 1):
+            self.stats["out_of_order"] += 1
+            logging.warning(f"[{reading['cust_id']}] skipping reading of {reading['time']} out of time order")
+            return
+        if state.direction == 1:
+            self._emit(reading, last)
+        else:
+            # Descending: the held reading's predecessor is the one just read.
+            self._emit(last, reading)
+        state.last = reading
+
+    def finish(self) -> dict:
+        for state in self._states.values():
+            if state.direction != 1 and state.last is not None:
+                self._emit(state.last, self._stored_before(state.last))
+                state.last = None
+        self._flush()
+        for cust_id, state in self._states.items():
+            if state.oldest is not None:
+                self._rederive(cust_id, state.oldest, state.newest)
+        return self.stats
+
+    def _rederive(self, cust_id: str, oldest: datetime, newest: datetime):
+        """
+        Recompute the deltas of the stored readings from ``oldest`` to the first one after ``newest``: they were
+        computed against their neighbours before the import, the reading after a backfilled gap spans the whole gap.
+        """
+        following = [decode_log(log) for log in self.repository.find_logs(
+            {"cust_id": cust_id, "time": {"$gt": newest}}, {"_id": 0, "time": 1}, sort=[("time", 1)], limit=1)]
+        end = following[0]["time"] if following else newest
+        previous = self._stored_before({"cust_id": cust_id, "time": oldest})
+        projection = {"_id": 1, "time": 1, "used_amp": 1, "res_amp": 1, "difference": 1, "prev_used_amp": 1,
+                      "prev_res_amp": 1, "prev_ratio": 1}
+        cursor = self.repository.find_logs({"cust_id": cust_id, "time": {"$gte": oldest, "$lte": end}}, projection,
+                                           sort=[("time", 1)]).batch_size(self.batch_size)
+        updates = []
+        try:
+            for log in cursor:
+                log = decode_log(log)
+                changed = {key: Decimal128(value) for key, value in compute_deltas(log, previous).items()
+                           if log.get(key) != value}
+                if changed:
+                    updates.append((log["_id"], changed))
+                if len(updates) >= self.batch_size:
+                    self.stats["rederived"] += self.repository.update_logs(updates)
+                    updates = []
+                previous = log
+        finally:
+            cursor.close()
+        self.stats["rederived"] += self.repository.update_logs(updates)
+
+    def _stored_before(self, reading: dict) -> dict | None:
+        """The latest stored reading older than ``reading``, the predecessor of the oldest imported one."""
+        cursor = self.repository.find_logs({"cust_id": reading["cust_id"], "time": {"$lt": reading["time"]}},
+                                           {"_id": 0, "used_amp": 1, "res_amp": 1}, sort=[("time", -1)], limit=1)
+        logs = [decode_log(log) for log in cursor]
+        return logs[0] if logs else None
+
+    def _emit(self, reading: dict, previous: dict | None):
+        state = self._states[reading["cust_id"]]
+        state.oldest = reading["time"] if state.oldest is None else min(state.oldest, reading["time"])
+        state.newest = reading["time"] if state.newest is None else max(state.newest, reading["time"])
+        document = dict(reading, difference=reading["used_amp"] - reading["res_amp"], prev_used_amp=Decimal(0),
+                        prev_res_amp=Decimal(0), prev_ratio=Decimal(0))
+        if previous is not None:
+            document["prev_used_amp"] = reading["used_amp"] - previous["used_amp"]
+            document["prev_res_amp"] = reading["res_amp"] - previous["res_amp"]
+            if document["prev_used_amp"] != Decimal(0) and document["prev_res_amp"] != Decimal(0):
+                document["prev_ratio"] = document["prev_used_amp"] / abs(document["prev_res_amp"])
+        for key, value in document.items():
+            if isinstance(value, Decimal):
+                document[key] = Decimal128(value)
+        self._batch.append(document)
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        inserted = self.repository.insert_logs(self._batch)
+        new = sum(inserted)
+        self.stats["inserted"] += new
+        self.stats["duplicate"] += len(inserted) - new
+        self._batch = []
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from bson.decimal128 import Decimal128
+
+from database import get_repository
+
+DECIMAL_FIELDS: tuple = ("used_amp", "res_amp", "difference", "prev_used_amp", "prev_res_amp", "prev_ratio")
+
+
+class JournalEntry(object):
+    def __init__(self, log: dict):
+        self.log: dict = log
+        self.inserted: bool | None = None
+        self.flushed = threading.Event()
+
+
+def encode_entry(log: dict) -> str:
+    data = {}
+    for key, value in log.items():
+        if isinstance(value, Decimal):
+            value = str(value)
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        data[key] = value
+    return json.dumps(data, ensure_ascii=False)
+
+
+def decode_entry(line: str) -> dict:
+    log = json.loads(line)
+    for key in DECIMAL_FIELDS:
+        if key in log:
+            log[key] = Decimal(log[key])
+    log["time"] = datetime.fromisoformat(log["time"])
+    return log
+
+
+def to_document(log: dict) -> dict:
+    return {key: Decimal128(value) if isinstance(value, Decimal) else value for key, value in log.items()}
+
+
+class WriteAheadJournal(object):
+    """
+    Append-only file of readings that are not stored in the database yet. Readings are appended before they are
+    inserted, flushed to the database in batches and removed from the file once stored, so nothing is lost while
+    the database is slow or down and the backlog is replayed in order when it comes back.
+    """
+
+    def __init__(self, path: str, fsync: bool = True, batch_size: int = 500):
+        self.path: str = path
+        self.fsync: bool = fsync
+        self.batch_size: int = max(1, batch_size)
+        self._pending: list = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.flushed_total: int = 0
+        self.duplicate_total: int = 0
+        self.failure_total: int = 0
+        self.last_flush_seconds: float = 0.0
+        self.last_error: str | None = None
+        self._load()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    self._pending.append(JournalEntry(decode_entry(line)))
+                except (ValueError, KeyError) as err:
+                    # A crash in the middle of an append leaves a truncated last line behind.
+                    logging.warning(f"Skipping unreadable journal line: {err}")
+        if self._pending:
+            logging.info(f"Loaded {len(self._pending)} readings from the journal {self.path}")
+
+    def _sync(self, file):
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+
+    def append(self, log: dict) -> JournalEntry:
+        entry = JournalEntry(dict(log))
+        line = encode_entry(entry.log) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._sync(self._file)
+            self._pending.append(entry)
+        return entry
+
+    def _compact(self, flushed: int):
+        # Drops the flushed entries and rewrites the file with the remaining ones.
+        with self._lock:
+            self._pending = self._pending[flushed:]
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                for entry in self._pending:
+                    file.write(encode_entry(entry.log) + "\n")
+                self._sync(file)
+            self._file.close()
+            os.replace(temp_path, self.path)
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+    def flush(self, on_inserted=None) -> int:
+        """Insert the backlog in order, returns the number of readings flushed (inserted or duplicate)."""
+        with self._flush_lock:
+            with self._lock:
+                entries = list(self._pending)
+            if not entries:
+                return 0
+            started = time.perf_counter()
+            flushed = 0
+            try:
+                for index in range(0, len(entries), self.batch_size):
+                    batch = entries[index:index + self.batch_size]
+                    results = get_repository().insert_logs([to_document(entry.log) for entry in batch])
+                    for entry, inserted in zip(batch, results):
+                        entry.inserted = inserted
+                        if inserted and on_inserted is not None:
+                            on_inserted(entry.log)
+                        entry.flushed.set()
+                    flushed += len(batch)
+                    self.flushed_total += sum(1 for inserted in results if inserted)
+                    self.duplicate_total += sum(1 for inserted in results if not inserted)
+                self.last_error = None
+            except Exception as err:
+                self.failure_total += 1
+                self.last_error = str(err)
+                logging.error(f"Failed to flush the journal, {len(entries) - flushed} readings are kept: {err}")
+            finally:
+                if flushed:
+                    self._compact(flushed)
+                self.last_flush_seconds = time.perf_counter() - started
+            return flushed
+
+    def pending_logs(self) -> list:
+        """The readings not stored yet, oldest first."""
+        with self._lock:
+            return [dict(entry.log) for entry in self._pending]
+
+    def backlog(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def stats(self) -> dict:
+        return {
+            "backlog": self.backlog(),
+            "flushed_total": self.flushed_total,
+            "duplicate_total": self.duplicate_total,
+            "failure_total": self.failure_total,
+            "last_flush_seconds": self.last_flush_seconds,
+            "last_error": self.last_error
+        }
+
+    def close(self):
+        with self._lock:
+            self._file.close()
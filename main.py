@@ -1,29 +1,79 @@
 # # Ignore the IDE warning "Parameter 'request' value is not used". Do not modify!
+import asyncio
 import csv
+import functools
+import hashlib
 import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import timedelta
+from email.utils import formatdate, parsedate_to_datetime
 from enum import IntEnum
+from typing import Optional
 from urllib.request import Request
 
 import uvicorn
 from apscheduler.schedulers.background import BackgroundScheduler
 from fastapi import FastAPI, Depends, HTTPException
 from pydantic import BaseModel
-from starlette.responses import JSONResponse, StreamingResponse
+from starlette.requests import Request as HTTPRequest
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 
+from alerts import alert_engine
+from broadcast import Broadcaster
+from database import get_repository, close_repository
+from metrics import Gauge, HTTP_REQUEST_SECONDS, PARSE_SECONDS, SCHEDULER_LAG_SECONDS, registry
 from electricity import *
 from electricity import ElectricityInfo
+from forecast import depletion_forecast
+from poller import AdaptiveInterval, ElectricityPoller
+from rollups import get_rollups
+from series import SERIES_MIN_POINTS, get_series
+from singleflight import ExpiringCache, SingleFlight
 from student import *
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(application: FastAPI):
+    repository = get_repository()
+    repository.connect()
+    try:
+        repository.ensure_indexes()
+    except Exception as err:
+        logging.error(f"Failed to create database indexes: {err}")
+    try:
+        latest_logs.warm(CUST_IDS)
+    except Exception as err:
+        logging.error(f"Failed to warm the latest log cache: {err}")
+    # warm() replaced the cache with the stored readings, the journal's are newer.
+    seed_latest_logs()
+    if journal is not None:
+        await run_blocking(database_executor, journal.flush, notify_inserted)
+    broadcaster.start(asyncio.get_running_loop())
+    yield
+    broadcaster.stop()
+    if alert_engine is not None:
+        alert_engine.close()
+    upstream_executor.shutdown(wait=False)
+    database_executor.shutdown(wait=False)
+    close_repository()
+
+
+app = FastAPI(lifespan=lifespan)
 scheduler = BackgroundScheduler()
+# requests and pymongo are blocking, handlers run them on these pools instead of the event loop. Upstream calls get
+# their own pool so a slow school site can never starve the database reads behind cheap endpoints such as /.
+upstream_executor = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix="upstream")
+database_executor = ThreadPoolExecutor(max_workers=DATABASE_WORKERS, thread_name_prefix="database")
 logging.basicConfig(format='[%(asctime)s] - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
                     level=logging.INFO)
 
 
 class LogType(IntEnum):
     JSON = 0,
-    CSV = 1
+    CSV = 1,
+    NDJSON = 2
 
 
 class ResponseJson(BaseModel):
@@ -43,6 +93,18 @@ class ResponseJson(BaseModel):
         return result
 
 
+class LogFilter(BaseModel):
+    cust_id: Optional[str] = None
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    min_res_amp: Optional[Decimal] = None
+    max_res_amp: Optional[Decimal] = None
+    min_prev_used_amp: Optional[Decimal] = None
+    max_prev_used_amp: Optional[Decimal] = None
+    limit: int = 100
+    cursor: Optional[str] = None
+
+
 class AccessDenied(Exception):
     def __init__(self, status_code: int = 400, message: str = "", data: dict = None):
         self.status_code = status_code
@@ -74,6 +136,60 @@ async def http_exception_handler(request: Request, exc: HTTPException) -> JSONRe
     )
 
 
+@app.middleware("http")
+async def metrics_middleware(request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method,
+                                 path=route.path if route is not None else "unmatched",
+                                 status=response.status_code)
+    return response
+
+
+async def run_blocking(executor: ThreadPoolExecutor, func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def localize(value: datetime | None) -> datetime | None:
+    if value is not None and value.tzinfo is None:
+        return TIMEZONE.localize(value)
+    return value
+
+
+def cache_validators(request: HTTPRequest, last_time: datetime | None, cache_control: str,
+                     version: tuple = (0, None), stored_at: datetime = None) -> tuple:
+    """
+    Return the caching headers of a response whose content only changes with the latest reading at ``last_time``,
+    with a reading stored at ``stored_at`` or with the data ``version`` bumped by manage.py, and whether the
+    request's If-None-Match/If-Modified-Since show the client already has it.
+    """
+    headers = {"Cache-Control": cache_control}
+    if last_time is None:
+        return headers, False
+    query = sorted((key, value) for key, value in request.query_params.multi_items() if key != "access_token")
+    stored = stored_at.isoformat() if stored_at is not None else ""
+    validator = f"{request.url.path}|{query}|{last_time.isoformat()}|{stored}|{version[0]}"
+    digest = hashlib.sha1(validator.encode("utf-8")).hexdigest()
+    # Readings older than last_time (another dormitory's, or imported offline) leave it unchanged, the time they
+    # were stored or the data version was bumped moves Last-Modified.
+    last_modified = max(time for time in (last_time, stored_at, version[1]) if time is not None)
+    last_modified = last_modified.astimezone(utc).replace(microsecond=0)
+    headers["ETag"] = f'W/"{digest[:20]}"'
+    headers["Last-Modified"] = formatdate(last_modified.timestamp(), usegmt=True)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return headers, "*" in tags or headers["ETag"] in tags or headers["ETag"][2:] in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return headers, last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            pass
+    return headers, False
+
+
 def verify_token(access_token: str = None):
     if access_token != ACCESS_TOKEN:
         raise AccessDenied(status_code=400, message="Invalid access_token", data={})
@@ -89,6 +205,7 @@ def get_electricity(cust_id=None) -> ElectricityInfo | None:
         }
         result = json.loads(login_session.send_post("interface/index", data).text)
         cust_id = result["data"][0]["CustId"]
+    cust_id = str(cust_id)
     data = {
         'method': 'geteldorbaseinfo',
         'stuid': 1,
@@ -101,81 +218,256 @@ def get_electricity(cust_id=None) -> ElectricityInfo | None:
         raise err
     if response is None or response.text == "":
         return
-    result = json.loads(response.text)
-    if result["state"] != 200:
-        logging.error(json.loads(response.text))
-        return
-    return ElectricityInfo(json.loads(response.text))
+    with PARSE_SECONDS.time():
+        result = json.loads(response.text)
+        if result["state"] != 200:
+            logging.error(result)
+            return
+        return ElectricityInfo(result, cust_id)
 
 
-def scheduler_job():
-    global login_session
+upstream_flight = SingleFlight()
+recent_readings = ExpiringCache()
+
+
+def _fetch_and_remember(cust_id=None) -> ElectricityInfo | None:
+    ei = get_electricity(cust_id)
+    if ei is not None:
+        recent_readings.set(cust_id, ei)
+    return ei
+
+
+def fetch_electricity(cust_id=None, max_age: timedelta = UPSTREAM_FRESHNESS) -> ElectricityInfo | None:
+    # A reading fetched within max_age is served as is, and concurrent fetches of the same dormitory (several
+    # /get callers, the scheduler) share one request to the school site.
+    cust_id = None if cust_id is None else str(cust_id)
+    ei = recent_readings.get(cust_id, max_age)
+    if ei is not None:
+        return ei
+    return upstream_flight.do(cust_id, _fetch_and_remember, cust_id)
+
+
+if journal is not None:
+    registry.register(Gauge("electricity_journal_backlog", "Readings in the journal waiting for the database.",
+                            journal.backlog))
+    registry.register(Gauge("electricity_journal_last_flush_seconds", "Duration of the last journal flush.",
+                            lambda: journal.last_flush_seconds))
+
+broadcaster = Broadcaster(lambda log: json.dumps(log, default=json_default, ensure_ascii=False),
+                          queue_size=STREAM_QUEUE_SIZE, max_subscribers=STREAM_MAX_CLIENTS)
+add_insert_listener(broadcaster.publish)
+registry.register(Gauge("electricity_stream_subscribers", "Clients connected to /stream.",
+                        broadcaster.subscriber_count))
+
+poller = ElectricityPoller(fetch_electricity, CUST_IDS, workers=POLLING_WORKERS,
+                           dorm_min_interval=POLLING_DORM_MIN_INTERVAL,
+                           request_spacing=POLLING_REQUEST_SPACING)
+
+
+def observe_scheduler_lag(planned_run: datetime | None):
+    if planned_run is not None:
+        SCHEDULER_LAG_SECONDS.observe(max(0.0, (datetime.now() - planned_run).total_seconds()))
+
+
+def scheduler_job(planned_run: datetime = None):
+    observe_scheduler_lag(planned_run)
     next_run = datetime.now().replace(second=0, microsecond=0) + TIME_INTERVAL
     logging.info("Next run will be at {}.".format(next_run.strftime("%Y-%m-%d %H:%M:%S")))
-    scheduler.add_job(scheduler_job, 'date', run_date=next_run)
+    scheduler.add_job(scheduler_job, 'date', run_date=next_run, args=[next_run])
+    results = poller.poll_all()
+    inserted = sum(1 for result in results if result.inserted)
+    buffered = sum(1 for result in results if result.buffered)
+    failed = sum(1 for result in results if result.error is not None)
+    logging.info(f"Polled {len(results)} dormitories: {inserted} inserted, {buffered} buffered, {failed} failed.")
+
+
+adaptive_interval = AdaptiveInterval(TIME_INTERVAL, ADAPTIVE_MIN_INTERVAL, ADAPTIVE_MAX_INTERVAL,
+                                     margin=ADAPTIVE_MARGIN, low_balance=ADAPTIVE_LOW_BALANCE,
+                                     low_balance_interval=ADAPTIVE_LOW_BALANCE_INTERVAL)
+
+
+def adaptive_scheduler_job(cust_id: str, planned_run: datetime = None):
+    observe_scheduler_lag(planned_run)
+    delay = None
     try:
-        ei = get_electricity(CUST_ID)
-    except requests.exceptions.ConnectionError:
-        logging.error(f"Failed to connect to {BASE_URL}, this task is discarded.")
-        return
-    except LoginFailedException:
-        logging.error(f"Failed to login to {BASE_URL}, this task is discarded.")
-        return
-    #  logging.info(ei.to_dict())
-    if ei.insert2db() is not None:
-        logging.info(f"Data inserted successfully: {ei.to_dict()}")
-    else:
-        logging.info(f"Same data exists in the database, skipping")
+        result = poller.poll(cust_id)
+        if result.skipped:
+            delay = ADAPTIVE_MIN_INTERVAL
+        else:
+            delay = adaptive_interval.observe(cust_id, result.reading)
+    finally:
+        # The next run is scheduled even if polling raised, otherwise this dormitory would never be polled again.
+        if delay is None:
+            delay = adaptive_interval.observe(cust_id, None)
+        next_run = datetime.now() + delay
+        logging.info(f"[{cust_id}] Next run will be at {next_run.strftime('%Y-%m-%d %H:%M:%S')}.")
+        scheduler.add_job(adaptive_scheduler_job, 'date', run_date=next_run, args=[cust_id, next_run])
 
 
 @app.get("/")
 # access_token: str = Depends(verify_token)
-async def root_endpoint() -> ResponseJson:
-    try:
-        last_log = get_logs()[0]
-        return ResponseJson(200, "", last_log)
-    except IndexError:
+async def root_endpoint(request: HTTPRequest, response: Response, cust_id: str = CUST_ID) -> ResponseJson:
+    version = await run_blocking(database_executor, data_version.get)
+    last_log = await run_blocking(database_executor, latest_logs.get, cust_id)
+    if last_log is None:
         return ResponseJson(404, "No logs found", {})
+    headers, not_modified = cache_validators(request, last_log["time"], ROOT_CACHE_CONTROL, version,
+                                             store_times.get(cust_id))
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return ResponseJson(200, "", last_log)
 
 
 @app.get("/get")
-async def get_endpoint(access_token: str = Depends(verify_token), cust_id: int = CUST_ID) -> ResponseJson:
-    global login_session
+async def get_endpoint(access_token: str = Depends(verify_token), cust_id: str = CUST_ID,
+                       force: bool = False) -> ResponseJson:
+    max_age = timedelta(0) if force else UPSTREAM_FRESHNESS
     try:
-        response: ElectricityInfo = get_electricity(cust_id)
+        response: ElectricityInfo = await run_blocking(upstream_executor, fetch_electricity, cust_id, max_age)
     except requests.exceptions.ConnectionError as err:
         return ResponseJson(500, f"Failed to connect to {BASE_URL}, this task is discarded.", vars(err))
+    except LoginFailedException:
+        return ResponseJson(500, f"Failed to login to {BASE_URL}, this task is discarded.", {})
+    if response is None:
+        return ResponseJson(500, f"No data returned from {BASE_URL}", {})
 
-    if cust_id != CUST_ID:
+    if str(cust_id) not in poller.cust_ids:
         result = response.to_dict()
         result["is_inserted"] = False
+        result["is_buffered"] = False
         return ResponseJson(200, "", result)
 
-    is_inserted = response.insert2db() is not None
-    if is_inserted:
+    insert_result = await run_blocking(database_executor, response.insert2db)
+    is_buffered_reading = is_buffered(insert_result)
+    is_inserted = insert_result is not None and not is_buffered_reading
+    if is_buffered_reading:
+        logging.warning(f"Database unavailable, reading kept in the journal: {response.to_dict()}")
+    elif is_inserted:
         logging.info(f"Data inserted successfully: {response.to_dict()}")
     else:
         logging.info(f"Same data exists in the database, skipping")
     result = response.to_dict()
     result["is_inserted"] = is_inserted
+    result["is_buffered"] = is_buffered_reading
     return ResponseJson(200, "", result)
 
 
+async def iter_events(subscription):
+    try:
+        # The first comment makes proxies and browsers treat the connection as established.
+        yield ": connected\n\n"
+        while True:
+            try:
+                payload = await asyncio.wait_for(subscription.queue.get(), STREAM_HEARTBEAT.total_seconds())
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            if payload is None:
+                return
+            yield f"event: reading\ndata: {payload}\n\n"
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+@app.get("/stream", response_model=None)
+# access_token: str = Depends(verify_token)
+async def stream_endpoint(cust_id: str = None) -> StreamingResponse | JSONResponse:
+    subscription = broadcaster.subscribe(cust_id)
+    if subscription is None:
+        return JSONResponse(status_code=503, content=ResponseJson(503, "Too many stream clients", {}).to_dict())
+    return StreamingResponse(iter_events(subscription), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.get("/logs", response_model=None)
-async def logs_endpoint(limit: int = 1, reverse: bool = True, file_type: LogType = LogType.JSON,
-                        access_token: str = Depends(verify_token)) -> StreamingResponse | ResponseJson:
-    logs = get_logs(limit=limit, ascending_order=not reverse)
+async def logs_endpoint(request: HTTPRequest, response: Response, limit: int = 1, reverse: bool = True,
+                        file_type: LogType = LogType.JSON, cust_id: str = None,
+                        access_token: str = Depends(verify_token)) -> Response | ResponseJson:
+    # The logs only change when a reading is stored, which the latest log cache and store_times know without a
+    # query, or when manage.py bumped the data version.
+    version = await run_blocking(database_executor, data_version.get)
+    last_time = await run_blocking(database_executor, latest_logs.last_modified, cust_id)
+    headers, not_modified = cache_validators(request, last_time, LOGS_CACHE_CONTROL, version,
+                                             store_times.get(cust_id))
+    if not_modified:
+        return Response(status_code=304, headers=headers)
     if file_type == LogType.CSV:
-        csv_content = list_dict_to_csv(logs)
+        logs = iter_logs(limit=limit, ascending_order=not reverse, cust_id=cust_id)
         filename = f"logs_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
-        return StreamingResponse(iter([csv_content]), media_type='text/csv',
-                                 headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+        return StreamingResponse(iter_csv(logs, log_fields()), media_type='text/csv',
+                                 headers=dict(headers, **{'Content-Disposition': f'attachment; filename="{filename}"'}))
+    if file_type == LogType.NDJSON:
+        logs = iter_logs(limit=limit, ascending_order=not reverse, cust_id=cust_id)
+        filename = f"logs_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.ndjson"
+        return StreamingResponse(iter_ndjson(logs), media_type='application/x-ndjson',
+                                 headers=dict(headers, **{'Content-Disposition': f'attachment; filename="{filename}"'}))
+    logs = await run_blocking(database_executor, get_logs, limit=limit, ascending_order=not reverse, cust_id=cust_id)
+    response.headers.update(headers)
     return ResponseJson(200, "", logs)
 
 
-@app.post("logs_by_filter")
-async def logs_by_filter_endpoint(reverse: bool = True, access_token: str = Depends(verify_token)) -> ResponseJson:
-    pass
+@app.post("/logs_by_filter")
+async def logs_by_filter_endpoint(log_filter: LogFilter, reverse: bool = True,
+                                  access_token: str = Depends(verify_token)) -> ResponseJson:
+    if not 0 < log_filter.limit <= LOGS_FILTER_MAX_LIMIT:
+        return ResponseJson(400, f"limit must be between 1 and {LOGS_FILTER_MAX_LIMIT}", {})
+    filter_ = build_log_filter(log_filter.cust_id, localize(log_filter.start), localize(log_filter.end),
+                               log_filter.min_res_amp, log_filter.max_res_amp,
+                               log_filter.min_prev_used_amp, log_filter.max_prev_used_amp)
+    try:
+        logs, next_cursor = await run_blocking(database_executor, find_logs_page, filter_, log_filter.limit,
+                                               not reverse, log_filter.cursor)
+    except ValueError as err:
+        return ResponseJson(400, str(err), {})
+    return ResponseJson(200, "", {"logs": logs, "next_cursor": next_cursor})
+
+
+@app.get("/stats/{period}")
+async def stats_endpoint(period: str, cust_id: str = CUST_ID, start: datetime = None, end: datetime = None,
+                         limit: int = 24, reverse: bool = True,
+                         access_token: str = Depends(verify_token)) -> ResponseJson:
+    try:
+        rollups = await run_blocking(database_executor, get_rollups, cust_id, period, localize(start), localize(end),
+                                     limit, not reverse)
+    except ValueError as err:
+        return ResponseJson(400, str(err), {})
+    return ResponseJson(200, "", rollups)
+
+
+@app.get("/series")
+async def series_endpoint(cust_id: str = CUST_ID, field: str = "res_amp", start: datetime = None,
+                          end: datetime = None, points: int = 500, method: str = "lttb",
+                          access_token: str = Depends(verify_token)) -> ResponseJson:
+    min_points = SERIES_MIN_POINTS.get(method, 1)
+    if not min_points <= points <= SERIES_MAX_POINTS:
+        return ResponseJson(400, f"points must be between {min_points} and {SERIES_MAX_POINTS}", {})
+    try:
+        series = await run_blocking(database_executor, get_series, cust_id, field, localize(start), localize(end),
+                                    points, method)
+    except ValueError as err:
+        return ResponseJson(400, str(err), {})
+    return ResponseJson(200, "", series)
+
+
+@app.get("/forecast")
+async def forecast_endpoint(cust_id: str = CUST_ID, access_token: str = Depends(verify_token)) -> ResponseJson:
+    forecast = await run_blocking(database_executor, depletion_forecast.get, cust_id)
+    if forecast is None:
+        return ResponseJson(404, "No logs found", {})
+    return ResponseJson(200, "", forecast)
+
+
+@app.get("/journal")
+async def journal_endpoint(access_token: str = Depends(verify_token)) -> ResponseJson:
+    if journal is None:
+        return ResponseJson(404, "The journal is disabled", {})
+    return ResponseJson(200, "", journal.stats())
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint(access_token: str = Depends(verify_token)) -> PlainTextResponse:
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 
 # @app.get("/set_cookie")
@@ -200,37 +492,69 @@ async def logs_by_filter_endpoint(reverse: bool = True, access_token: str = Depe
 
 @app.get("/logout")
 async def get_cookie_endpoint(access_token: str = Depends(verify_token)) -> ResponseJson:
-    global login_session
     try:
-        login_session.logout()
+        await run_blocking(upstream_executor, login_session.logout)
         return ResponseJson(200, "", {})
     except requests.exceptions.ConnectionError as err:
         return ResponseJson(500, f"Failed to connect to {BASE_URL}, this task is discarded.", vars(err))
 
 
-def list_dict_to_csv(data: list) -> str:
-    if data is None or len(data) == 0:
-        return ""
-    fields = set()
-    for row in data:
-        fields.update(row.keys())
-    fields = sorted(set.union(*[set(row.keys()) for row in data]), key=lambda x: (x != "time", x))
+def iter_csv(logs, fields: list, batch_size: int = LOGS_BATCH_SIZE):
+    # Rows are written to a small buffer that is flushed every batch_size rows, so memory stays constant
+    # no matter how many logs the cursor yields.
     output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=fields, lineterminator='\n')
+    writer = csv.DictWriter(output, fieldnames=fields, lineterminator='\n', extrasaction='ignore')
     writer.writeheader()
-    for row in data:
-        if isinstance(row["time"], datetime):
+    count = 0
+    for row in logs:
+        if isinstance(row.get("time"), datetime):
             row["time"] = row["time"].strftime("%Y-%m-%d %H:%M:%S")
         writer.writerow(row)
-    return output.getvalue()
+        count += 1
+        if count % batch_size == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+    if output.tell():
+        yield output.getvalue()
+
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def iter_ndjson(logs, batch_size: int = LOGS_BATCH_SIZE):
+    lines = []
+    for row in logs:
+        lines.append(json.dumps(row, default=json_default, ensure_ascii=False))
+        if len(lines) >= batch_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
 
 
 if __name__ == "__main__":
     try:
-        login_session: StudentRequest = StudentRequest(BASE_URL, StudentLoginMethod(SID, PASSWORD))
+        login_session: StudentRequest = StudentRequest(BASE_URL, StudentLoginMethod(SID, PASSWORD),
+                                                       session_file=SESSION_FILE,
+                                                       refresh_interval=SESSION_REFRESH_INTERVAL)
     except ModuleNotFoundError:
         logging.error("config.py is not configured properly.")
         exit(1)
-    scheduler.add_job(scheduler_job)
+    if SCHEDULING_MODE == "adaptive":
+        for dorm_id in poller.cust_ids:
+            scheduler.add_job(adaptive_scheduler_job, args=[dorm_id])
+    else:
+        scheduler.add_job(scheduler_job)
+    if journal is not None:
+        scheduler.add_job(journal.flush, 'interval', seconds=JOURNAL_FLUSH_INTERVAL.total_seconds(),
+                          args=[notify_inserted])
+    if SESSION_REFRESH_INTERVAL is not None:
+        scheduler.add_job(login_session.refresh_if_due, 'interval', minutes=1)
     scheduler.start()
     uvicorn.run(app, host="0.0.0.0", port=PORT, log_config=LOGGING_CONFIG)
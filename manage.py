@@ -0,0 +1,145 @@
+import argparse
+import logging
+
+from config import *
+from database import get_repository, close_repository
+from importer import IMPORT_FORMATS, LogImporter
+from recompute import DeltaRecomputer
+from rollups import rebuild_rollups
+
+
+def tag_legacy_logs(cust_id: str = CUST_ID) -> int:
+    # Readings stored before multi-dormitory polling have no cust_id unless LOGGING_ADDR was enabled.
+    result = get_repository().collection.update_many({"cust_id": {"$exists": False}},
+                                                     {"$set": {"cust_id": str(cust_id)}})
+    logging.info(f"Tagged {result.modified_count} legacy logs with cust_id {cust_id}")
+    return result.modified_count
+
+
+def remove_duplicate_logs(batch_size: int = 1000) -> int:
+    # Keeps the first stored log of every (cust_id, time) pair so the unique index can be created.
+    collection = get_repository().collection
+    pipeline = [
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": {"cust_id": "$cust_id", "time": "$time"}, "ids": {"$push": "$_id"},
+                    "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]
+    removed = 0
+    pending = []
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        pending.extend(group["ids"][1:])
+        if len(pending) >= batch_size:
+            removed += collection.delete_many({"_id": {"$in": pending}}).deleted_count
+            pending = []
+    if pending:
+        removed += collection.delete_many({"_id": {"$in": pending}}).deleted_count
+    logging.info(f"Removed {removed} duplicate logs")
+    return removed
+
+
+def migrate_to_compact(batch_size: int = 5000) -> int:
+    from compact import CompactLogRepository
+    source = get_repository()
+    target = CompactLogRepository(source.url, source.database_name, source.collection_name,
+                                  source.rollup_collection_name, COMPACT_COLLECTION, DORM_COLLECTION,
+                                  COMPACT_DECIMALS, source.meta_collection_name, **source.client_options)
+    try:
+        target.ensure_indexes()
+        migrated = target.migrate(source, batch_size)
+    finally:
+        target.close()
+    logging.info(f"Migrated {migrated} logs to {COMPACT_COLLECTION}, set STORAGE_SCHEMA = \"compact\" to use them")
+    return migrated
+
+
+def import_logs(paths: list, file_format: str = None, cust_id: str = None, batch_size: int = 1000,
+                update_rollups: bool = True) -> dict:
+    importer = LogImporter(batch_size, cust_id)
+    for path in paths:
+        importer.import_file(path, file_format)
+        logging.info(f"Read {path}: {importer.stats}")
+    stats = importer.finish()
+    logging.info(f"Imported {stats['inserted']} logs: {stats}")
+    if update_rollups:
+        for imported_cust_id in importer.cust_ids:
+            rebuild_rollups(imported_cust_id)
+    return stats
+
+
+def recompute_deltas(cust_ids: list, restart: bool = False, batch_size: int = 500, pause: float = 0.0,
+                     update_rollups: bool = True) -> dict:
+    recomputer = DeltaRecomputer(RECOMPUTE_CHECKPOINT_FILE, RECOMPUTE_MAX_GAP, RECOMPUTE_RECHARGE_THRESHOLD,
+                                 batch_size, pause)
+    for cust_id in cust_ids:
+        if restart:
+            recomputer.reset(cust_id)
+        if recomputer.recompute(cust_id) and update_rollups:
+            rebuild_rollups(cust_id)
+    logging.info(f"Recomputed deltas: {recomputer.stats}")
+    return recomputer.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the electricity database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    tag_parser = subparsers.add_parser("tag-legacy", help="Tag logs without a cust_id with the given dormitory.")
+    tag_parser.add_argument("--cust-id", default=CUST_ID)
+
+    subparsers.add_parser("dedup", help="Remove duplicate logs and create the unique (cust_id, time) index.")
+
+    rollup_parser = subparsers.add_parser("rebuild-rollups", help="Recompute the consumption rollups from the logs.")
+    rollup_parser.add_argument("--cust-id", default=None)
+
+    migrate_parser = subparsers.add_parser("migrate-compact",
+                                           help="Copy the logs into the compact time-series collection (resumable).")
+    migrate_parser.add_argument("--batch-size", type=int, default=5000)
+
+    import_parser = subparsers.add_parser("import",
+                                          help="Import CSV or NDJSON exports of /logs, recomputing the deltas.")
+    import_parser.add_argument("paths", nargs="+")
+    import_parser.add_argument("--format", choices=IMPORT_FORMATS, default=None,
+                               help="Defaults to ndjson for .ndjson/.jsonl/.json files and csv otherwise")
+    import_parser.add_argument("--cust-id", default=None, help="Dormitory of rows without a cust_id column")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+    import_parser.add_argument("--skip-rollups", action="store_true",
+                               help="Do not rebuild the rollups of the imported dormitories")
+
+    recompute_parser = subparsers.add_parser(
+        "recompute-deltas", help="Rewrite difference/prev_* in time order, reporting gaps and recharges (resumable).")
+    recompute_parser.add_argument("--cust-id", action="append", default=None, help="Defaults to CUST_IDS")
+    recompute_parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint of an interrupted run")
+    recompute_parser.add_argument("--batch-size", type=int, default=500)
+    recompute_parser.add_argument("--pause", type=float, default=0.0, help="Seconds to sleep between two batches")
+    recompute_parser.add_argument("--skip-rollups", action="store_true",
+                                  help="Do not rebuild the rollups of dormitories whose logs were rewritten")
+
+    args = parser.parse_args()
+    if args.command in ("tag-legacy", "dedup", "migrate-compact") and DATABASE_BACKEND != "mongodb":
+        parser.error(f"{args.command} only applies to the MongoDB backend")
+    try:
+        if args.command == "tag-legacy":
+            tag_legacy_logs(args.cust_id)
+        elif args.command == "dedup":
+            remove_duplicate_logs()
+            get_repository().ensure_indexes()
+        elif args.command == "rebuild-rollups":
+            rebuild_rollups(args.cust_id)
+        elif args.command == "migrate-compact":
+            migrate_to_compact(args.batch_size)
+        elif args.command == "import":
+            import_logs(args.paths, args.format, args.cust_id, args.batch_size, not args.skip_rollups)
+        elif args.command == "recompute-deltas":
+            recompute_deltas(args.cust_id or CUST_IDS, args.restart, args.batch_size, args.pause,
+                             not args.skip_rollups)
+        # A running server rereads the version within DATA_VERSION_REFRESH and stops answering 304 for stale data.
+        get_repository().bump_data_version()
+    finally:
+        close_repository()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='[%(asctime)s] - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    main()
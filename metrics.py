@@ -0,0 +1,164 @@
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS: tuple = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    type_name: str = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: tuple = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> list:
+        """Return (suffix, labels, value) tuples."""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return [("", dict(zip(self.labelnames, key)), value) for key, value in values]
+
+
+class Gauge(Metric):
+    """A gauge whose value is read from ``callback`` at scrape time."""
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> list:
+        value = self.callback()
+        return [] if value is None else [("", {}, value)]
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets: tuple = tuple(sorted(buckets)) + (math.inf,)
+        self._values: dict = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self._values.items()]
+        samples = []
+        for key, bucket_counts, total, count in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", dict(labels, le=_format_value(bound)), cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics: dict = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = Registry()
+
+UPSTREAM_REQUEST_SECONDS: Histogram = registry.register(Histogram(
+    "electricity_upstream_request_seconds", "Latency of requests to the school site.", ("method", "path")))
+UPSTREAM_LOGIN_SECONDS: Histogram = registry.register(Histogram(
+    "electricity_upstream_login_seconds", "Latency of a full login to the school site."))
+RELOGIN_TOTAL: Counter = registry.register(Counter(
+    "electricity_relogin_total", "Logins to the school site.", ("reason",)))
+PARSE_SECONDS: Histogram = registry.register(Histogram(
+    "electricity_parse_seconds", "Time spent parsing upstream JSON into a reading."))
+DATABASE_SECONDS: Histogram = registry.register(Histogram(
+    "electricity_database_seconds", "Latency of database operations.", ("operation",)))
+READINGS_TOTAL: Counter = registry.register(Counter(
+    "electricity_readings_total", "Readings passed to insert2db by result.", ("result",)))
+SCHEDULER_LAG_SECONDS: Histogram = registry.register(Histogram(
+    "electricity_scheduler_lag_seconds", "Delay between the planned and the actual start of a scheduler job.",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)))
+HTTP_REQUEST_SECONDS: Histogram = registry.register(Histogram(
+    "electricity_http_request_seconds", "Latency of API requests.", ("method", "path", "status")))
+ALERTS_TOTAL: Counter = registry.register(Counter(
+    "electricity_alerts_total", "Alerts by rule and result (sent, failed, suppressed, dropped).", ("rule", "result")))
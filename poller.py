@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Callable
+
+import requests
+
+from electricity import is_buffered
+from student import LoginFailedException
+
+
+class RateLimiter(object):
+    def __init__(self, min_interval: timedelta):
+        self.min_interval: float = min_interval.total_seconds()
+        self._next_allowed: dict = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key=None) -> float:
+        """Block until ``key`` may be used again, returns the number of seconds waited."""
+        with self._lock:
+            now = time.monotonic()
+            allowed_at = max(now, self._next_allowed.get(key, now))
+            self._next_allowed[key] = allowed_at + self.min_interval
+        delay = allowed_at - now
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def try_acquire(self, key=None) -> bool:
+        """Like ``acquire`` but returns False instead of waiting."""
+        with self._lock:
+            now = time.monotonic()
+            if self._next_allowed.get(key, now) > now:
+                return False
+            self._next_allowed[key] = now + self.min_interval
+            return True
+
+
+class PollResult(object):
+    def __init__(self, cust_id: str, inserted: bool = False, skipped: bool = False, error: str = None,
+                 reading=None, buffered: bool = False):
+        self.cust_id = cust_id
+        self.inserted = inserted
+        self.buffered = buffered
+        self.skipped = skipped
+        self.error = error
+        self.reading = reading
+
+
+class ElectricityPoller(object):
+    def __init__(self, fetch: Callable, cust_ids: list, workers: int = 4,
+                 dorm_min_interval: timedelta = timedelta(0), request_spacing: timedelta = timedelta(0)):
+        self.fetch = fetch
+        self.cust_ids: list = [str(cust_id) for cust_id in cust_ids]
+        self.workers: int = max(1, workers)
+        # dorm_limiter keeps a single dorm from being polled again too soon, request_limiter spaces out the
+        # requests of all workers so the school server never sees a burst of N simultaneous calls.
+        self.dorm_limiter = RateLimiter(dorm_min_interval)
+        self.request_limiter = RateLimiter(request_spacing)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="poller")
+
+    def poll_all(self) -> list:
+        return list(self.executor.map(self.poll, self.cust_ids))
+
+    def poll(self, cust_id: str) -> PollResult:
+        if not self.dorm_limiter.try_acquire(cust_id):
+            logging.info(f"[{cust_id}] Polled too recently, skipping")
+            return PollResult(cust_id, skipped=True)
+        self.request_limiter.acquire()
+        try:
+            ei = self.fetch(cust_id)
+        except requests.exceptions.ConnectionError:
+            logging.error(f"[{cust_id}] Failed to connect to the school site, this task is discarded.")
+            return PollResult(cust_id, error="connection")
+        except LoginFailedException:
+            logging.error(f"[{cust_id}] Failed to login to the school site, this task is discarded.")
+            return PollResult(cust_id, error="login")
+        except Exception as err:
+            # An unexpected response (bad JSON, missing fields) must not escape into the scheduler and stop polling.
+            logging.exception(f"[{cust_id}] Unexpected error while fetching, this task is discarded: {err}")
+            return PollResult(cust_id, error="unexpected")
+        if ei is None:
+            logging.error(f"[{cust_id}] No data returned from the school site, this task is discarded.")
+            return PollResult(cust_id, error="empty")
+        try:
+            result = ei.insert2db()
+        except Exception as err:
+            logging.error(f"[{cust_id}] Failed to insert data: {err}")
+            return PollResult(cust_id, error="database")
+        if is_buffered(result):
+            logging.warning(f"[{cust_id}] Database unavailable, reading kept in the journal: {ei.to_dict()}")
+            return PollResult(cust_id, buffered=True, reading=ei)
+        inserted = result is not None
+        if inserted:
+            logging.info(f"[{cust_id}] Data inserted successfully: {ei.to_dict()}")
+        else:
+            logging.info(f"[{cust_id}] Same data exists in the database, skipping")
+        return PollResult(cust_id, inserted=inserted, reading=ei)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class DormCadence(object):
+    def __init__(self):
+        self.meter_time: datetime | None = None
+        self.update_interval: float | None = None
+        self.static_polls: int = 0
+        self.failures: int = 0
+
+
+class AdaptiveInterval(object):
+    """
+    Learns how often the meter of each dormitory updates (the upstream ``Time`` field) and picks the delay until the
+    next poll: shortly after the next expected update, sooner when the balance is low, and exponentially later while
+    the reading does not change. Delays are always clamped to [min_interval, max_interval].
+    """
+
+    def __init__(self, base_interval: timedelta, min_interval: timedelta, max_interval: timedelta,
+                 margin: timedelta = timedelta(seconds=30), low_balance: Decimal = None,
+                 low_balance_interval: timedelta = None, smoothing: float = 0.3):
+        self.base_interval: float = base_interval.total_seconds()
+        self.min_interval: float = min_interval.total_seconds()
+        self.max_interval: float = max_interval.total_seconds()
+        self.margin: float = margin.total_seconds()
+        self.low_balance: Decimal | None = low_balance
+        self.low_balance_interval: float | None = \
+            low_balance_interval.total_seconds() if low_balance_interval is not None else None
+        self.smoothing: float = smoothing
+        self._cadences: dict = {}
+        self._lock = threading.Lock()
+
+    def _clamp(self, seconds: float) -> timedelta:
+        return timedelta(seconds=min(self.max_interval, max(self.min_interval, seconds)))
+
+    def observe(self, cust_id: str, reading, now: datetime = None) -> timedelta:
+        """Record the result of a poll (``reading`` is None when it failed) and return the delay until the next one."""
+        with self._lock:
+            cadence = self._cadences.setdefault(cust_id, DormCadence())
+            if reading is None:
+                cadence.failures += 1
+                return self._clamp(self.base_interval * 2 ** min(cadence.failures, 6))
+            cadence.failures = 0
+            if cadence.meter_time is not None and reading.time > cadence.meter_time:
+                interval = (reading.time - cadence.meter_time).total_seconds()
+                cadence.update_interval = interval if cadence.update_interval is None else \
+                    self.smoothing * interval + (1 - self.smoothing) * cadence.update_interval
+                cadence.static_polls = 0
+            elif cadence.meter_time is not None:
+                cadence.static_polls += 1
+            cadence.meter_time = reading.time if cadence.meter_time is None else max(cadence.meter_time, reading.time)
+
+            backoff = 2 ** min(cadence.static_polls, 6)
+            if cadence.update_interval is not None:
+                now = now or datetime.now(reading.time.tzinfo)
+                until_update = (cadence.meter_time - now).total_seconds() + cadence.update_interval + self.margin
+                # Overdue updates are retried with a growing delay rather than in a tight loop.
+                delay = until_update if until_update > 0 else self.min_interval * backoff
+            else:
+                delay = self.base_interval * backoff
+            if self.low_balance is not None and self.low_balance_interval is not None \
+                    and reading.res_amp <= self.low_balance:
+                delay = min(delay, self.low_balance_interval)
+            return self._clamp(delay)
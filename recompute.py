@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from bson.decimal128 import Decimal128
+
+from database import get_repository
+from electricity import decode_log
+
+DELTA_FIELDS: tuple = ("prev_used_amp", "prev_res_amp", "prev_ratio")
+
+
+def compute_deltas(log: dict, previous: dict | None) -> dict:
+    """
+    The derived fields of ``log`` against the reading that really preceded it, with the same rules as insert2db and
+    the importer. Recharges are only reported, so a recomputed reading never differs from a freshly polled one.
+    """
+    deltas = {"difference": log["used_amp"] - log["res_amp"], "prev_used_amp": Decimal(0),
+              "prev_res_amp": Decimal(0), "prev_ratio": Decimal(0)}
+    if previous is None:
+        return deltas
+    deltas["prev_used_amp"] = log["used_amp"] - previous["used_amp"]
+    deltas["prev_res_amp"] = log["res_amp"] - previous["res_amp"]
+    if deltas["prev_used_amp"] != Decimal(0) and deltas["prev_res_amp"] != Decimal(0):
+        deltas["prev_ratio"] = deltas["prev_used_amp"] / abs(deltas["prev_res_amp"])
+    return deltas
+
+
+class DeltaRecomputer(object):
+    """
+    Walks the logs of each dormitory in time order and rewrites difference/prev_* where they differ from the values
+    computed against the actual previous reading. Gaps longer than ``max_gap`` and recharges (res_amp rising by at
+    least ``recharge_threshold``) are reported. Progress is saved to ``checkpoint_file`` after every batch and
+    dropped once a dormitory was scanned to the end: a checkpoint only resumes an interrupted run, the next complete
+    run starts over and sees readings inserted out of order before the checkpoint.
+    """
+
+    def __init__(self, checkpoint_file: str | None, max_gap: timedelta, recharge_threshold: Decimal,
+                 batch_size: int = 500, pause: float = 0.0):
+        self.checkpoint_file: str | None = checkpoint_file
+        self.max_gap: timedelta = max_gap
+        self.recharge_threshold: Decimal = recharge_threshold
+        self.batch_size: int = max(1, batch_size)
+        self.pause: float = pause
+        self.repository = get_repository()
+        self.checkpoints: dict = self.load_checkpoints()
+        self.stats: dict = {"scanned": 0, "updated": 0, "gaps": 0, "recharges": 0}
+
+    def load_checkpoints(self) -> dict:
+        if self.checkpoint_file is None or not os.path.exists(self.checkpoint_file):
+            return {}
+        with open(self.checkpoint_file) as file:
+            return json.load(file)
+
+    def save_checkpoints(self):
+        if self.checkpoint_file is None:
+            return
+        temp_file = f"{self.checkpoint_file}.tmp"
+        with open(temp_file, 'w') as file:
+            json.dump(self.checkpoints, file, indent=2)
+        os.replace(temp_file, self.checkpoint_file)
+
+    def reset(self, cust_id: str = None):
+        if cust_id is None:
+            self.checkpoints = {}
+        else:
+            self.checkpoints.pop(str(cust_id), None)
+        self.save_checkpoints()
+
+    def recompute(self, cust_id: str) -> bool:
+        """Returns whether any log of ``cust_id`` was rewritten."""
+        cust_id = str(cust_id)
+        checkpoint = self.checkpoints.get(cust_id)
+        filter_ = {"cust_id": cust_id}
+        previous = None
+        if checkpoint is not None:
+            filter_["time"] = {"$gt": datetime.fromisoformat(checkpoint["time"])}
+            previous = {"time": datetime.fromisoformat(checkpoint["time"]),
+                        "used_amp": Decimal(checkpoint["used_amp"]), "res_amp": Decimal(checkpoint["res_amp"])}
+        projection = {"_id": 1, "time": 1, "used_amp": 1, "res_amp": 1, "difference": 1, "prev_used_amp": 1,
+                      "prev_res_amp": 1, "prev_ratio": 1}
+        cursor = self.repository.find_logs(filter_, projection, sort=[("time", 1)]).batch_size(self.batch_size)
+        updates = []
+        updated = 0
+        scanned = 0
+        try:
+            for log in cursor:
+                log = decode_log(log)
+                self.stats["scanned"] += 1
+                scanned += 1
+                self.inspect(cust_id, log, previous)
+                deltas = compute_deltas(log, previous)
+                changed = {key: Decimal128(value) for key, value in deltas.items() if log.get(key) != value}
+                if changed:
+                    updates.append((log["_id"], changed))
+                previous = log
+                # Counted in scanned rows, not rewritten ones: a mostly correct history is checkpointed too.
+                if scanned % self.batch_size == 0:
+                    updated += self.flush(cust_id, updates, previous)
+                    updates = []
+            updated += self.flush(cust_id, updates, previous)
+        finally:
+            cursor.close()
+        self.reset(cust_id)
+        logging.info(f"[{cust_id}] Recomputed deltas, {updated} logs rewritten")
+        return updated > 0
+
+    def inspect(self, cust_id: str, log: dict, previous: dict | None):
+        """Report a gap or a recharge before ``log``."""
+        if previous is None:
+            return
+        gap = log["time"] - previous["time"]
+        if gap > self.max_gap:
+            self.stats["gaps"] += 1
+            logging.info(f"[{cust_id}] Gap of {gap} before {log['time']}")
+        if log["res_amp"] - previous["res_amp"] >= self.recharge_threshold:
+            self.stats["recharges"] += 1
+            logging.info(f"[{cust_id}] Recharge of {log['res_amp'] - previous['res_amp']} at {log['time']}")
+
+    def flush(self, cust_id: str, updates: list, last: dict | None) -> int:
+        modified = self.repository.update_logs(updates) if updates else 0
+        self.stats["updated"] += modified
+        if last is not None:
+            self.checkpoints[cust_id] = {"time": last["time"].isoformat(), "used_amp": str(last["used_amp"]),
+                                         "res_amp": str(last["res_amp"])}
+            self.save_checkpoints()
+        if self.pause:
+            # Leaves the database to the scheduler's inserts between two batches.
+            time.sleep(self.pause)
+        return modified
@@ -0,0 +1,52 @@
+import logging
+from datetime import datetime
+from decimal import Decimal
+
+from bson.decimal128 import Decimal128
+
+from config import *
+from database import get_repository
+from electricity import add_insert_listener, decode_log
+
+PERIODS: tuple = ("hour", "day", "month")
+
+
+def period_start(time: datetime, period: str) -> datetime:
+    local_time = time.astimezone(TIMEZONE)
+    if period == "hour":
+        start = local_time.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+    elif period == "day":
+        start = local_time.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    elif period == "month":
+        start = local_time.replace(day=1, hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    else:
+        raise ValueError(f"Unknown period: {period}")
+    return TIMEZONE.localize(start)
+
+
+def update_rollups(log: dict):
+    starts = {period: period_start(log["time"], period) for period in PERIODS}
+    get_repository().increment_rollups(str(log["cust_id"]), starts,
+                                       Decimal128(Decimal(log["prev_used_amp"])),
+                                       Decimal128(Decimal(log["res_amp"])))
+
+
+def get_rollups(cust_id: str, period: str, start: datetime = None, end: datetime = None, limit: int = 0,
+                ascending_order=False) -> list:
+    if period not in PERIODS:
+        raise ValueError(f"Unknown period: {period}")
+    if start is not None:
+        start = period_start(start, period)
+    cursor = get_repository().find_rollups(str(cust_id), period, start, end, limit, ascending_order)
+    return [decode_log(rollup) for rollup in cursor]
+
+
+def rebuild_rollups(cust_id: str = None):
+    repository = get_repository()
+    repository.ensure_indexes()
+    for period in PERIODS:
+        repository.rebuild_rollups(period, TIMEZONE.zone, None if cust_id is None else str(cust_id))
+        logging.info(f"Rebuilt {period} rollups{'' if cust_id is None else f' of {cust_id}'}")
+
+
+add_insert_listener(update_rollups)
@@ -0,0 +1,80 @@
+from datetime import datetime
+
+import numpy as np
+
+from database import get_repository
+
+SERIES_FIELDS: tuple = ("used_amp", "res_amp", "difference", "prev_used_amp", "prev_res_amp", "prev_ratio")
+SERIES_METHODS: tuple = ("lttb", "minmax")
+# Smallest budget each method can honour exactly: LTTB always keeps both ends plus one point per bucket, minmax the
+# minimum and the maximum of a bucket.
+SERIES_MIN_POINTS: dict = {"lttb": 3, "minmax": 2}
+
+
+def load_series(cust_id: str, field: str, start: datetime = None, end: datetime = None) -> tuple:
+    """Return (epoch milliseconds, values) arrays of ``field`` in time order."""
+    if field not in SERIES_FIELDS:
+        raise ValueError(f"Unknown field: {field}")
+    documents = list(get_repository().find_series(str(cust_id), field, start, end))
+    x = np.fromiter((document["t"] for document in documents), dtype=np.int64, count=len(documents))
+    y = np.fromiter((document["v"] for document in documents), dtype=np.float64, count=len(documents))
+    return x, y
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> tuple:
+    """Largest-Triangle-Three-Buckets downsampling, keeps the first and the last point."""
+    n = len(x)
+    if threshold >= n or n <= 2:
+        return x, y
+    if threshold < 3:
+        return x[[0, n - 1]], y[[0, n - 1]]
+    xf = x.astype(np.float64)
+    # threshold - 2 buckets share the points between the first and the last one.
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_start, next_stop = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        avg_x = xf[next_start:next_stop].mean()
+        avg_y = y[next_start:next_stop].mean()
+        area = np.abs((xf[a] - avg_x) * (y[start:stop] - y[a]) - (xf[a] - xf[start:stop]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return x[selected], y[selected]
+
+
+def minmax(x: np.ndarray, y: np.ndarray, threshold: int) -> tuple:
+    """Fixed-bucket downsampling keeping the minimum and the maximum of each bucket."""
+    n = len(x)
+    if threshold >= n or n == 0:
+        return x, y
+    buckets = max(1, threshold // 2)
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    bucket_ids = np.repeat(np.arange(buckets), np.diff(edges))
+    # Sorting by (bucket, value) puts each bucket's minimum at its first slot and its maximum at its last slot.
+    order = np.lexsort((y, bucket_ids))
+    selected = np.unique(np.concatenate([order[edges[:-1]], order[edges[1:] - 1]]))
+    return x[selected], y[selected]
+
+
+def downsample(x: np.ndarray, y: np.ndarray, points: int, method: str = "lttb") -> tuple:
+    if method == "lttb":
+        return lttb(x, y, points)
+    if method == "minmax":
+        return minmax(x, y, points)
+    raise ValueError(f"Unknown method: {method}")
+
+
+def get_series(cust_id: str, field: str = "res_amp", start: datetime = None, end: datetime = None,
+               points: int = 500, method: str = "lttb") -> dict:
+    x, y = load_series(cust_id, field, start, end)
+    sampled_x, sampled_y = downsample(x, y, points, method)
+    return {
+        "field": field,
+        "method": method,
+        "total": int(len(x)),
+        "points": [list(point) for point in zip(sampled_x.tolist(), sampled_y.tolist())]
+    }
@@ -0,0 +1,58 @@
+import threading
+import time
+from datetime import timedelta
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls with the same key into one call whose result is shared by every caller."""
+
+    def __init__(self):
+        self._calls: dict = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class ExpiringCache(object):
+    def __init__(self):
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, max_age: timedelta):
+        with self._lock:
+            entry = self._values.get(key)
+        if entry is None or time.monotonic() - entry[0] > max_age.total_seconds():
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = (time.monotonic(), value)
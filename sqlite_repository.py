@@ -0,0 +1,392 @@
+"""
+SQLite storage backend with the interface of database.LogRepository, for small deployments without a MongoDB server.
+Queries are given in the subset of the MongoDB query language that the rest of the code builds (build_log_filter,
+page cursors) and translated to SQL. Amounts are stored as TEXT so Decimals round-trip exactly, times as UTC epoch
+milliseconds like MongoDB's dates.
+"""
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytz
+from bson.decimal128 import Decimal128
+
+EPOCH: datetime = datetime(1970, 1, 1, tzinfo=pytz.utc)
+DECIMAL_COLUMNS: tuple = ("used_amp", "res_amp", "difference", "prev_used_amp", "prev_res_amp", "prev_ratio")
+LOG_COLUMNS: tuple = ("cust_id", "time") + DECIMAL_COLUMNS + ("addr", "Name")
+SQL_OPERATORS: dict = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def to_milliseconds(time: datetime) -> int:
+    # Naive datetimes are UTC, as pymongo treats them.
+    if time.tzinfo is None:
+        time = pytz.utc.localize(time)
+    return (time - EPOCH) // timedelta(milliseconds=1)
+
+
+def from_milliseconds(milliseconds: int) -> datetime:
+    # Naive UTC like the datetimes pymongo returns, decode_log localizes them.
+    return datetime(1970, 1, 1) + timedelta(milliseconds=milliseconds)
+
+
+def to_text(value) -> str | None:
+    if value is None:
+        return None
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+    return str(Decimal(value) if not isinstance(value, Decimal) else value)
+
+
+class SQLiteCursor(object):
+    """Iterates over the rows of a query, fetching ``batch_size`` rows per lock acquisition."""
+
+    def __init__(self, repository, sql: str, params: list, columns: list):
+        self.repository = repository
+        self.sql: str = sql
+        self.params: list = params
+        self.columns: list = columns
+        self._batch_size: int = 1000
+        self._cursor = None
+
+    def batch_size(self, batch_size: int):
+        self._batch_size = max(1, batch_size)
+        return self
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+
+    def __iter__(self):
+        with self.repository.lock:
+            self._cursor = self.repository.connect().execute(self.sql, self.params)
+        try:
+            while True:
+                with self.repository.lock:
+                    rows = self._cursor.fetchmany(self._batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield self.repository.decode_row(self.columns, row)
+        finally:
+            self.close()
+
+
+class SQLiteLogRepository(object):
+    def __init__(self, path: str, collection_name: str = "log", rollup_collection_name: str = "rollup",
+                 meta_collection_name: str = "meta"):
+        self.path: str = path
+        self.collection_name: str = collection_name
+        self.rollup_collection_name: str = rollup_collection_name
+        self.meta_collection_name: str = meta_collection_name
+        self.connection: sqlite3.Connection | None = None
+        # One connection is shared by all threads, every use of it holds this lock.
+        self.lock = threading.RLock()
+
+    def connect(self) -> sqlite3.Connection:
+        with self.lock:
+            if self.connection is None:
+                self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+                if self.path != ":memory:":
+                    self.connection.execute("PRAGMA journal_mode=WAL")
+                    # In WAL mode NORMAL only risks the last transactions on power loss, never corruption.
+                    self.connection.execute("PRAGMA synchronous=NORMAL")
+                self._create_tables()
+                logging.info(f"SQLite database opened: {self.path}")
+            return self.connection
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+                logging.info("SQLite database closed")
+
+    def _create_tables(self):
+        decimal_columns = ", ".join(f"{column} TEXT" for column in DECIMAL_COLUMNS)
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {self.collection_name} ("
+                                f"id INTEGER PRIMARY KEY, cust_id TEXT, time INTEGER NOT NULL, {decimal_columns}, "
+                                f"addr TEXT, Name TEXT)")
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {self.rollup_collection_name} ("
+                                f"cust_id TEXT NOT NULL, period TEXT NOT NULL, start INTEGER NOT NULL, used TEXT, "
+                                f"count INTEGER, min_res_amp TEXT, max_res_amp TEXT, "
+                                f"PRIMARY KEY (cust_id, period, start))")
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {self.meta_collection_name} ("
+                                f"key TEXT PRIMARY KEY, version INTEGER NOT NULL, time INTEGER NOT NULL)")
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        # The same indexes as the MongoDB backend: (cust_id, time) deduplicates readings and serves per-dormitory
+        # queries, (time, id) serves queries across all dormitories.
+        with self.lock:
+            connection = self.connect()
+            connection.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {self.collection_name}_cust_id_time "
+                               f"ON {self.collection_name} (cust_id, time)")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.collection_name}_time "
+                               f"ON {self.collection_name} (time, id)")
+
+    # Query translation
+
+    @staticmethod
+    def _column(key: str) -> str:
+        if key == "_id":
+            return "id"
+        if key not in LOG_COLUMNS:
+            raise ValueError(f"Unknown field: {key}")
+        return key
+
+    @staticmethod
+    def _param(key: str, value):
+        if isinstance(value, datetime):
+            return to_milliseconds(value)
+        if key in DECIMAL_COLUMNS and value is not None:
+            return float(Decimal(to_text(value)))
+        if key == "_id":
+            return int(value)
+        return value
+
+    def _where(self, filter_: dict, params: list) -> str:
+        clauses = []
+        for key, condition in filter_.items():
+            if key in ("$and", "$or"):
+                parts = [self._where(part, params) for part in condition]
+                clauses.append("(" + (" AND " if key == "$and" else " OR ").join(parts or ["1"]) + ")")
+                continue
+            column = self._column(key)
+            # Amounts are TEXT, comparisons are made on their numeric value.
+            expression = f"CAST({column} AS REAL)" if key in DECIMAL_COLUMNS else column
+            if not (isinstance(condition, dict) and condition and all(name.startswith("$") for name in condition)):
+                condition = {"$eq": condition}
+            for operator, operand in condition.items():
+                if operator == "$exists":
+                    clauses.append(f"{column} IS {'NOT ' if operand else ''}NULL")
+                elif operand is None and operator in ("$eq", "$ne"):
+                    clauses.append(f"{column} IS {'NOT ' if operator == '$ne' else ''}NULL")
+                elif operator == "$in":
+                    clauses.append(f"{expression} IN ({', '.join('?' * len(operand)) or 'NULL'})")
+                    params.extend(self._param(key, item) for item in operand)
+                elif operator in SQL_OPERATORS:
+                    clauses.append(f"{expression} {SQL_OPERATORS[operator]} ?")
+                    params.append(self._param(key, operand))
+                else:
+                    raise ValueError(f"Unsupported filter operator: {operator}")
+        return " AND ".join(clauses) or "1"
+
+    def _order_by(self, sort: list = None) -> str:
+        if not sort:
+            return ""
+        return " ORDER BY " + ", ".join(f"{self._column(key)} {'ASC' if direction > 0 else 'DESC'}"
+                                        for key, direction in sort)
+
+    @staticmethod
+    def decode_row(columns: list, row: tuple) -> dict:
+        document = {}
+        for column, value in zip(columns, row):
+            if column == "id":
+                document["_id"] = value
+            elif column == "time" and value is not None:
+                document["time"] = from_milliseconds(value)
+            elif column in DECIMAL_COLUMNS and value is not None:
+                document[column] = Decimal(value)
+            else:
+                document[column] = value
+        return document
+
+    # Logs
+
+    def find_logs(self, filter_: dict = None, projection: dict = None, sort: list = None, limit: int = 0):
+        if projection:
+            columns = [self._column(key) for key, value in projection.items() if value]
+        else:
+            columns = ["id"] + list(LOG_COLUMNS)
+        params = []
+        sql = f"SELECT {', '.join(columns)} FROM {self.collection_name} WHERE {self._where(filter_ or {}, params)}" \
+              f"{self._order_by(sort)}"
+        if limit > 0:
+            sql += f" LIMIT {int(limit)}"
+        return SQLiteCursor(self, sql, params, columns)
+
+    def _insert(self, document: dict) -> sqlite3.Cursor:
+        values = [to_milliseconds(document[key]) if key == "time" else
+                  to_text(document.get(key)) if key in DECIMAL_COLUMNS else document.get(key)
+                  for key in LOG_COLUMNS]
+        return self.connect().execute(f"INSERT OR IGNORE INTO {self.collection_name} ({', '.join(LOG_COLUMNS)}) "
+                                      f"VALUES ({', '.join('?' * len(LOG_COLUMNS))})", values)
+
+    def insert_log(self, document: dict):
+        return self.upsert_log(document)
+
+    def upsert_log(self, document: dict):
+        """Insert ``document`` unless a log with the same cust_id and time exists, returns None for duplicates."""
+        with self.lock:
+            cursor = self._insert(document)
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def insert_logs(self, documents: list) -> list:
+        """Insert ``documents`` in one transaction, returns for each one whether it was new."""
+        if not documents:
+            return []
+        with self.lock:
+            connection = self.connect()
+            connection.execute("BEGIN")
+            try:
+                inserted = [self._insert(document).rowcount > 0 for document in documents]
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        return inserted
+
+    def update_logs(self, updates: list) -> int:
+        """Apply ``updates`` ([(_id, {field: value})]) in one transaction, returns the number modified."""
+        if not updates:
+            return 0
+        modified = 0
+        with self.lock:
+            connection = self.connect()
+            connection.execute("BEGIN")
+            try:
+                for _id, fields in updates:
+                    columns = [self._column(key) for key in fields]
+                    values = [to_text(value) if key in DECIMAL_COLUMNS else value for key, value in fields.items()]
+                    modified += connection.execute(
+                        f"UPDATE {self.collection_name} SET {', '.join(f'{column} = ?' for column in columns)} "
+                        f"WHERE id = ?", values + [_id]).rowcount
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        return modified
+
+    def find_series(self, cust_id: str, field: str, start=None, end=None, batch_size: int = 10000):
+        if field not in DECIMAL_COLUMNS:
+            raise ValueError(f"Unknown field: {field}")
+        filter_ = {"cust_id": cust_id, field: {"$ne": None}}
+        if start is not None or end is not None:
+            filter_["time"] = {key: value for key, value in (("$gte", start), ("$lte", end)) if value is not None}
+        params = []
+        sql = f"SELECT time, {field} FROM {self.collection_name} WHERE {self._where(filter_, params)} ORDER BY time"
+        with self.lock:
+            cursor = self.connect().execute(sql, params)
+        try:
+            while True:
+                with self.lock:
+                    rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                for time, value in rows:
+                    yield {"t": time, "v": float(value)}
+        finally:
+            cursor.close()
+
+    def data_version(self) -> tuple:
+        """(version, time of the last bump) of the stored data, (0, None) until it was first bumped."""
+        with self.lock:
+            row = self.connect().execute(f"SELECT version, time FROM {self.meta_collection_name} WHERE key = ?",
+                                         ("data_version",)).fetchone()
+        return (row[0], from_milliseconds(row[1])) if row is not None else (0, None)
+
+    def bump_data_version(self):
+        """Record that readings or rollups were changed outside of the running server."""
+        with self.lock:
+            self.connect().execute(f"INSERT INTO {self.meta_collection_name} (key, version, time) VALUES (?, 1, ?) "
+                                   f"ON CONFLICT (key) DO UPDATE SET version = version + 1, time = excluded.time",
+                                   ("data_version", to_milliseconds(datetime.now(pytz.utc))))
+
+    # Rollups
+
+    def _add_to_rollup(self, cust_id: str, period: str, start: int, used: Decimal, count: int, min_res_amp: Decimal,
+                       max_res_amp: Decimal):
+        connection = self.connect()
+        current = connection.execute(f"SELECT used, count, min_res_amp, max_res_amp FROM {self.rollup_collection_name}"
+                                     f" WHERE cust_id = ? AND period = ? AND start = ?",
+                                     (cust_id, period, start)).fetchone()
+        if current is not None:
+            used += Decimal(current[0])
+            count += current[1]
+            min_res_amp = min(min_res_amp, Decimal(current[2]))
+            max_res_amp = max(max_res_amp, Decimal(current[3]))
+        connection.execute(f"INSERT OR REPLACE INTO {self.rollup_collection_name} "
+                           f"(cust_id, period, start, used, count, min_res_amp, max_res_amp) "
+                           f"VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (cust_id, period, start, str(used), count, str(min_res_amp), str(max_res_amp)))
+
+    def increment_rollups(self, cust_id: str, starts: dict, used_amp, res_amp):
+        """Add one reading to the rollup of every period in ``starts`` ({period: period start})."""
+        used_amp = Decimal(to_text(used_amp))
+        res_amp = Decimal(to_text(res_amp))
+        with self.lock:
+            connection = self.connect()
+            connection.execute("BEGIN")
+            try:
+                for period, start in starts.items():
+                    self._add_to_rollup(cust_id, period, to_milliseconds(start), used_amp, 1, res_amp, res_amp)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def find_rollups(self, cust_id: str, period: str, start=None, end=None, limit: int = 0, ascending_order=False):
+        filter_ = "cust_id = ? AND period = ?"
+        params = [cust_id, period]
+        if start is not None:
+            filter_ += " AND start >= ?"
+            params.append(to_milliseconds(start))
+        if end is not None:
+            filter_ += " AND start <= ?"
+            params.append(to_milliseconds(end))
+        sql = f"SELECT start, used, count, min_res_amp, max_res_amp FROM {self.rollup_collection_name} " \
+              f"WHERE {filter_} ORDER BY start {'ASC' if ascending_order else 'DESC'}"
+        if limit > 0:
+            sql += f" LIMIT {int(limit)}"
+        with self.lock:
+            rows = self.connect().execute(sql, params).fetchall()
+        return [{"start": from_milliseconds(start), "used": Decimal(used), "count": count,
+                 "min_res_amp": Decimal(min_res_amp), "max_res_amp": Decimal(max_res_amp)}
+                for start, used, count, min_res_amp, max_res_amp in rows]
+
+    def rebuild_rollups(self, period: str, timezone_name: str, cust_id: str = None):
+        """Recompute the rollups of ``period`` from the raw logs in one ordered scan."""
+        timezone = pytz.timezone(timezone_name)
+
+        def truncate(milliseconds: int) -> int:
+            local_time = pytz.utc.localize(from_milliseconds(milliseconds)).astimezone(timezone)
+            fields = {"hour": dict(minute=0), "day": dict(hour=0, minute=0),
+                      "month": dict(day=1, hour=0, minute=0)}[period]
+            start = local_time.replace(second=0, microsecond=0, tzinfo=None, **fields)
+            return to_milliseconds(timezone.localize(start))
+
+        filter_ = {} if cust_id is None else {"cust_id": cust_id}
+        params = []
+        sql = f"SELECT cust_id, time, prev_used_amp, res_amp FROM {self.collection_name} " \
+              f"WHERE {self._where(filter_, params)} ORDER BY cust_id, time"
+        with self.lock:
+            connection = self.connect()
+            connection.execute("BEGIN")
+            try:
+                delete_params = [period] + ([] if cust_id is None else [cust_id])
+                connection.execute(f"DELETE FROM {self.rollup_collection_name} WHERE period = ?"
+                                   f"{'' if cust_id is None else ' AND cust_id = ?'}", delete_params)
+                group = None
+                # Rows come ordered by (cust_id, time), so only the rollup being summed is kept in memory.
+                for log_cust_id, time, prev_used_amp, res_amp in connection.execute(sql, params):
+                    key = (log_cust_id, truncate(time))
+                    used = Decimal(prev_used_amp or 0)
+                    res_amp = Decimal(res_amp)
+                    if group is not None and group[0] == key:
+                        group[1] += used
+                        group[2] += 1
+                        group[3] = min(group[3], res_amp)
+                        group[4] = max(group[4], res_amp)
+                        continue
+                    if group is not None:
+                        self._add_to_rollup(group[0][0], period, group[0][1], *group[1:])
+                    group = [key, used, 1, res_amp, res_amp]
+                if group is not None:
+                    self._add_to_rollup(group[0][0], period, group[0][1], *group[1:])
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
@@ -1,5 +1,9 @@
 import json
 import logging
+import os
+import threading
+import time
+from datetime import timedelta
 
 import requests
 import base64
@@ -7,6 +11,8 @@ import base64
 from requests.cookies import RequestsCookieJar
 from starlette import status
 
+from metrics import RELOGIN_TOTAL, UPSTREAM_LOGIN_SECONDS, UPSTREAM_REQUEST_SECONDS
+
 
 class LoginFailedException(Exception):
     def __init__(self, message="Login Failed!"):
@@ -24,8 +30,15 @@ class StudentRequest(object):
     def __init__(self, base_url: str, student_login_method: StudentLoginMethod, proxies=None,
                  user_agent: str = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 ('
                                    'KHTML, like Gecko)'
-                                   'Chrome/119.0.0.0 Safari/537.36'):
+                                   'Chrome/119.0.0.0 Safari/537.36',
+                 session_file: str = None, refresh_interval: timedelta = None):
         self.student_user = None
+        self.logged_in_at: float | None = None
+        self.session_file: str | None = session_file
+        self.refresh_interval: timedelta | None = refresh_interval
+        # The session is shared by the scheduler threads and the request handlers, logins are serialised so that
+        # several concurrent failures end up in a single re-login.
+        self._login_lock = threading.RLock()
         self.cookies: RequestsCookieJar = RequestsCookieJar()
         self.student_login_method = student_login_method
         self.base_url: str = base_url
@@ -55,6 +68,8 @@ class StudentRequest(object):
             'User-Agent': user_agent,
             'X-Requested-With': 'XMLHttpRequest'
         }
+        if self.session_file is not None:
+            self.restore_session()
 
     def get_cookies(self):
         try:
@@ -65,19 +80,27 @@ class StudentRequest(object):
         except requests.exceptions.ConnectionError as err:
             raise err
 
+    def _get(self, path):
+        with UPSTREAM_REQUEST_SECONDS.time(method="GET", path=path or "/"):
+            return self.session.get(f'{self.base_url}/{path}', headers=self.get_headers, proxies=self.proxies)
+
+    def _post(self, path, data, headers):
+        with UPSTREAM_REQUEST_SECONDS.time(method="POST", path=path or "/"):
+            return self.session.post(f'{self.base_url}/{path}', data, headers=headers, proxies=self.proxies)
+
     def send_get(self, path, need_login=True):
         try:
             if need_login and self.student_user is None:
-                if not self.login():
+                if not self.relogin(reason="initial"):
                     logging.error("Login failed")
                     raise LoginFailedException
-            response = self.session.get(f'{self.base_url}/{path}', headers=self.get_headers, proxies=self.proxies)
+            student_user = self.student_user
+            response = self._get(path)
             logging.info(f"GET {response.url} | Status code: {response.status_code}")
             if response.status_code != status.HTTP_200_OK and need_login:
                 logging.warning("Received non-200 status code, attempting to re-login and re-send request.")
-                if self.login():
-                    response = self.session.get(f'{self.base_url}/{path}', headers=self.get_headers,
-                                                proxies=self.proxies)
+                if self.relogin(student_user):
+                    response = self._get(path)
                     logging.info(
                         f"Re-sending GET request after successful re-login. Status code: {response.status_code}")
                 else:
@@ -90,19 +113,19 @@ class StudentRequest(object):
     def send_post(self, path, data=None, referer=None, need_login=True):
         try:
             if need_login and self.student_user is None:
-                if not self.login():
+                if not self.relogin(reason="initial"):
                     logging.error("Login failed")
                     raise LoginFailedException
             headers = self.post_headers
             if referer is not None:
-                headers['Referer'] = referer
-            response = self.session.post(f'{self.base_url}/{path}', data, headers=headers, proxies=self.proxies)
+                headers = dict(self.post_headers, Referer=referer)
+            student_user = self.student_user
+            response = self._post(path, data, headers)
             logging.info(f"POST {response.url} | Status code: {response.status_code}")
             if response.status_code != status.HTTP_200_OK and need_login:
                 logging.warning("Received non-200 status code, attempting to re-login and re-send request.")
-                if self.login():
-                    response = self.session.post(f'{self.base_url}/{path}', data, headers=headers,
-                                                 proxies=self.proxies)
+                if self.relogin(student_user):
+                    response = self._post(path, data, headers)
                     logging.info(
                         f"Re-sending POST request after successful re-login. Status code: {response.status_code}")
                 else:
@@ -112,7 +135,70 @@ class StudentRequest(object):
             logging.error(f"POST - Path: {path or '[Empty]'}, ERROR: {err}")
             raise err
 
+    def relogin(self, stale_user=None, reason: str = "failure"):
+        """
+        Log in unless another thread already replaced ``stale_user`` (the user a failed request was sent with)
+        while this one was waiting for the lock.
+        """
+        with self._login_lock:
+            if self.student_user is not None and self.student_user is not stale_user:
+                return self.student_user
+            RELOGIN_TOTAL.inc(reason=reason)
+            return self.login()
+
+    def refresh_if_due(self):
+        """Log in again before the session expires, meant to be called periodically."""
+        if self.refresh_interval is None or self.logged_in_at is None:
+            return None
+        if time.time() - self.logged_in_at < self.refresh_interval.total_seconds():
+            return None
+        logging.info("Refreshing the login session before it expires.")
+        return self.relogin(self.student_user, reason="refresh")
+
+    def save_session(self):
+        if self.session_file is None or self.student_user is None:
+            return
+        data = {
+            "student_user": self.student_user.get_dict(),
+            "logged_in_at": self.logged_in_at,
+            "cookies": [
+                {"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path}
+                for cookie in self.session.cookies
+            ]
+        }
+        temp_file = f"{self.session_file}.tmp"
+        # The file holds the login token, only the owner may read it.
+        with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+            json.dump(data, file)
+        os.replace(temp_file, self.session_file)
+
+    def restore_session(self):
+        if self.session_file is None or not os.path.exists(self.session_file):
+            return False
+        try:
+            with open(self.session_file) as file:
+                data = json.load(file)
+            for cookie in data["cookies"]:
+                self.session.cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"],
+                                         path=cookie["path"])
+            self.cookies = self.session.cookies
+            self.student_user = StudentUser(data["student_user"]["student_id"], data["student_user"]["token"])
+            self.logged_in_at = data.get("logged_in_at")
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            logging.warning(f"Failed to restore the login session from {self.session_file}: {err}")
+            return False
+        logging.info(f"Login session restored from {self.session_file}")
+        return True
+
+    def clear_session(self):
+        if self.session_file is not None and os.path.exists(self.session_file):
+            os.remove(self.session_file)
+
     def login(self):
+        with self._login_lock, UPSTREAM_LOGIN_SECONDS.time():
+            return self._login()
+
+    def _login(self):
         try:
             if self.session is None:
                 self.logout()
@@ -134,17 +220,22 @@ class StudentRequest(object):
             if result['state'] != 200:
                 return None
             self.student_user = StudentUser(result['data']['studentid'], result['data']['token'])
-            return StudentUser(result['data']['studentid'], result['data']['token'])
+            self.logged_in_at = time.time()
+            self.save_session()
+            return self.student_user
         except requests.exceptions.ConnectionError as err:
             raise err
 
     def logout(self):
         try:
             self.send_get("home/logout", need_login=False)
-            self.student_user = None
-            self.session.close()
-            self.session = requests.Session()
-            self.cookies = None
+            with self._login_lock:
+                self.student_user = None
+                self.logged_in_at = None
+                self.session.close()
+                self.session = requests.Session()
+                self.cookies = None
+                self.clear_session()
             return
         except requests.exceptions.ConnectionError as err:
             raise err